@@ -101,6 +101,7 @@ MAX_CHAT_SIZE = 90
 UPDATE_FPS = 60.0
 UPDATE_FREQUENCY = 1 / UPDATE_FPS
 NETWORK_FPS = 10.0
+FOG_DISTANCE = 128.0
 
 MAX_DAMAGE = 2
 
@@ -110,3 +111,6 @@ ROCKET_FALLOFF = 25.0
 MG_SHOOT_RATE = 0.2
 
 PROTOCOL_VERSION = 3
+
+# most blocks sent in one ServerBlockAction, so it always fits in a single datagram
+SERVER_BLOCK_ITEMS = 128
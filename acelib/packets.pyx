@@ -607,24 +607,26 @@ cdef class BlockAction(Loader):
 
 cdef class ServerBlockItem(Loader):
     cdef public:
-        uint8_t x, y, z
+        uint16_t x, y
+        uint8_t z
         Color color
 
     cpdef read(self, ByteReader reader):
         cdef bint has_color = reader.read_uint8()
-        self.x = reader.read_uint8()
-        self.y = reader.read_uint8()
+        self.x = reader.read_uint16()
+        self.y = reader.read_uint16()
         self.z = reader.read_uint8()
         if has_color:
-            self.color = Color().read(reader)
+            self.color = Color()
+            self.color.read(reader)
         else:
             self.color = None
 
     cpdef write(self, ByteWriter writer):
         cdef bint has_color = self.color is not None
         writer.write_uint8(has_color)
-        writer.write_uint8(self.x)
-        writer.write_uint8(self.y)
+        writer.write_uint16(self.x)
+        writer.write_uint16(self.y)
         writer.write_uint8(self.z)
         if has_color:
             self.color.write(writer)
@@ -646,6 +648,7 @@ cdef class ServerBlockAction(Loader):
 
     cpdef read(self, ByteReader reader):
         cdef uint32_t size  = reader.read_uint32()
+        self.items = []
         for x in range(size):
             block = ServerBlockItem()
             block.read(reader)
@@ -659,7 +662,8 @@ cdef class ServerBlockAction(Loader):
         for block in self.items:
             block.write(writer)
 
-    def add_block(self, uint8_t x, uint8_t y, uint8_t z, Color color):
+    def add_block(self, uint16_t x, uint16_t y, uint8_t z, Color color=None):
+        # no color removes the block
         block = ServerBlockItem()
         block.x = x
         block.y = y
@@ -7,11 +7,17 @@ cdef extern from "vxl_c.h" nogil:
     struct Pos3:
         int x, y, z
 
+    struct JournalItem:
+        int x, y, z
+        bool solid
+        uint32_t color
+
     cdef cppclass AceMap:
-        AceMap(uint8_t *buf) except +
-        void read(uint8_t *buf) except +
+        AceMap(const uint8_t *buf) except +
+        void read(const uint8_t *buf) except +
         vector[uint8_t] write() except +
         size_t write(vector[uint8_t] &v, int *sx, int *sy, int columns);
+        size_t write_chunk(vector[uint8_t] &v, size_t chunk) except +
 
         bool is_surface(int x, int y, int z) except +
         bool get_solid(int x, int y, int z, bool wrapped=False) except +
@@ -20,19 +26,36 @@ cdef extern from "vxl_c.h" nogil:
         void get_random_point(int *x, int *y, int *z, int x1, int y1, int x2, int y2)
         vector[Pos3] get_neighbors(int x, int y, int z)
         vector[Pos3] block_line(int x1, int y1, int z1, int x2, int y2, int z2)
+        vector[Pos3] build_line(int x1, int y1, int z1, int x2, int y2, int z2, uint32_t color, size_t limit) except +
 
         bool set_point(int x, int y, int z, bool solid, uint32_t color) except +
         void set_column_solid(int x, int y, int z_start, int z_end, bool solid) except +
         void set_column_color(int x, int y, int z_start, int z_end, uint32_t solid) except +
 
         bool check_node(int x, int y, int z, bool destroy)
+        vector[Pos3] destroy_points(const vector[Pos3] &points, size_t limit, vector[Pos3] *destroyed) except +
+        vector[Pos3] step_collapses(size_t limit) except +
+        size_t get_pending_collapses()
+
+        uint64_t get_revision()
+        vector[size_t] get_dirty_chunks(uint64_t since) except +
+
+        void set_journaling(bool enabled)
+        vector[JournalItem] get_journal() except +
+        size_t get_journal_size()
+
+        size_t memory_usage()
+        vector[uint8_t] write_snapshot() except +
+        bool read_snapshot(const uint8_t *buf, size_t size) except +
+        const uint64_t *get_geometry()
+        const uint8_t *get_heights()
 
     int get_pos(int x, int y, int z)
     bool is_valid_pos(int x, int y, int z)
     bool is_valid_pos(int pos)
     # int check_node(int x, int y, int z, AceMap *map, int destroy)
 
-    enum: MAP_X, MAP_Y, MAP_Z, DEFAULT_COLOR
+    enum: MAP_X, MAP_Y, MAP_Z, DEFAULT_COLOR, CHUNK_COLUMNS, MAP_CHUNKS
 
 cdef class VXLMap:
     cdef AceMap *map_data
@@ -45,11 +68,30 @@ cdef class VXLMap:
     cpdef bint set_point(self, int x, int y, int z, bool solid, uint32_t color=?, bool destroy=?)
     cpdef bint build_point(self, int x, int y, int z, tuple color)
     cpdef bint destroy_point(self, int x, int y, int z)
+    cpdef list destroy_points(self, points, size_t limit=?, list destroyed=?)
+    cpdef list step_collapses(self, size_t limit)
 
     cpdef list block_line(self, int x1, int y1, int z1, int x2, int y2, int z2)
+    cpdef list build_line(self, int x1, int y1, int z1, int x2, int y2, int z2, tuple color, limit=?)
     cpdef int get_z(self, int x, int y, int start=?)
+    cpdef uint32_t get_color(self, int x, int y, int z)
     cpdef tuple get_random_pos(self, int x1, int y1, int x2, int y2)
     cpdef bytes get_bytes(self)
+    cpdef bytes get_snapshot(self)
+    cpdef bytes get_chunk(self, size_t index)
+    cpdef list get_dirty_chunks(self, uint64_t since)
+    cpdef list get_journal(self)
+
+
+cdef class MapArray:
+    cdef:
+        VXLMap map
+        const void *data
+        vector[uint32_t] storage
+        Py_ssize_t itemsize
+        Py_ssize_t shape[2]
+        Py_ssize_t strides[2]
+        bytes format
 
 
 cdef class VXLMapIterator:
@@ -1,10 +1,13 @@
 # distutils: sources = acelib/vxl_c.cpp
+from cpython.buffer cimport PyBUF_WRITABLE, PyBUF_FORMAT, PyBUF_STRIDES, PyBUF_C_CONTIGUOUS
 import zlib
 
 VXL_MAP_X = MAP_X
 VXL_MAP_Y = MAP_Y
 VXL_MAP_Z = MAP_Z
 VXL_DEFAULT_COLOR = DEFAULT_COLOR
+VXL_CHUNK_COLUMNS = CHUNK_COLUMNS
+VXL_MAP_CHUNKS = MAP_CHUNKS
 
 
 cpdef inline block_color(int r, int g, int b):
@@ -12,25 +15,56 @@ cpdef inline block_color(int r, int g, int b):
 
 
 cdef class VXLMap:
-    def __cinit__(self, uint8_t *buffer=NULL, dict map_info=None):
-        self.map_data = new AceMap(buffer)
-        self.estimated_size = len(buffer)
+    def __cinit__(self, const uint8_t[:] buffer=None, dict map_info=None):
+        cdef const uint8_t *data = NULL
+        if buffer is not None:
+            data = &buffer[0]
+        # parsing doesn't need the GIL, so maps can be loaded in a worker thread without stalling the server
+        with nogil:
+            self.map_data = new AceMap(data)
+        self.estimated_size = len(buffer) if buffer is not None else 0
         self.map_info = map_info or {}
 
     def __dealloc__(self):
         del self.map_data
 
-    def __init__(self, uint8_t *buffer=NULL, dict map_info=None):
+    def __init__(self, const uint8_t[:] buffer=None, dict map_info=None):
         # just to make my ide happy LUL
         pass
 
+    @staticmethod
+    def from_snapshot(const uint8_t[:] buffer, dict map_info=None):
+        """Load a map from the data `get_snapshot` returned, which is a lot faster than parsing the vxl again."""
+        cdef:
+            VXLMap map = VXLMap(None, map_info)
+            bint ok = False
+        if buffer.shape[0]:
+            with nogil:
+                ok = map.map_data.read_snapshot(&buffer[0], buffer.shape[0])
+        if not ok:
+            raise ValueError("not a map snapshot, or one from a different map format")
+        return map
+
+    cpdef bytes get_snapshot(self):
+        cdef vector[uint8_t] v
+        with nogil:
+            v = self.map_data.write_snapshot()
+        return v.data()[:v.size()]
+
+    def copy(self):
+        cdef VXLMap other = VXLMap(None, dict(self.map_info))
+        with nogil:
+            other.map_data[0] = self.map_data[0]
+        other.estimated_size = self.estimated_size
+        return other
+
     def __iter__(self):
         cdef:
             int x = 0, y = 0, size
             vector[uint8_t] v
         v.reserve(1024)
         while True:
-            size = self.map_data.write(v, &x, &y, 128)
+            size = self.map_data.write(v, &x, &y, CHUNK_COLUMNS)
             if not size:
                 break
             yield v.data()[:size]
@@ -56,7 +90,8 @@ cdef class VXLMap:
         return ok
 
     cpdef bint build_point(self, int x, int y, int z, tuple color):
-        if not self.can_build(x, y, z):
+        # like build_line, only ever fill empty voxels. a build over an existing block would just recolor it
+        if not self.can_build(x, y, z) or self.map_data.get_solid(x, y, z):
             return False
 
         cdef vector[Pos3] neighbors = self.map_data.get_neighbors(x, y, z)
@@ -68,23 +103,71 @@ cdef class VXLMap:
     cpdef bint destroy_point(self, int x, int y, int z):
         if not self.can_build(x, y, z):
             return False
+        self.destroy_points(((x, y, z),))
+        return True
 
+    cpdef list destroy_points(self, points, size_t limit=0, list destroyed=None):
+        """
+        Destroy every (x, y, z) in `points` at once, then collapse anything no longer connected to the ground in a
+        single pass. Returns the collapsed voxels.
+
+        If `limit` is given, checks that would visit more than `limit` runs of voxels are left for `step_collapses`.
+        If `destroyed` is given, the points that were actually solid are appended to it.
+        """
         cdef:
-            bint ok = self.map_data.set_point(x, y, z, False, 0)
-            vector[Pos3] neighbors = self.map_data.get_neighbors(x, y, z)
+            vector[Pos3] c_points
+            vector[Pos3] collapsed
+            vector[Pos3] c_destroyed
+            vector[Pos3] *out = &c_destroyed if destroyed is not None else NULL
             Pos3 node
-        for node in neighbors:
-            if self.can_build(node.x, node.y, node.z):
-                self.map_data.check_node(node.x, node.y, node.z, True)
-        return ok
+        for node.x, node.y, node.z in points:
+            c_points.push_back(node)
+        with nogil:
+            collapsed = self.map_data.destroy_points(c_points, limit, out)
+        if destroyed is not None:
+            destroyed.extend([(node.x, node.y, node.z) for node in c_destroyed])
+        return [(node.x, node.y, node.z) for node in collapsed]
+
+    cpdef list step_collapses(self, size_t limit):
+        """
+        Continue the checks left over by `destroy_points`, visiting or collapsing at most `limit` runs of voxels.
+        Returns the voxels collapsed in this step.
+        """
+        cdef:
+            vector[Pos3] collapsed
+            Pos3 node
+        with nogil:
+            collapsed = self.map_data.step_collapses(limit)
+        return [(node.x, node.y, node.z) for node in collapsed]
+
+    @property
+    def pending_collapses(self):
+        return self.map_data.get_pending_collapses()
 
     cpdef list block_line(self, int x1, int y1, int z1, int x2, int y2, int z2):
         cdef vector[Pos3] line = self.map_data.block_line(x1, y1, z1, x2, y2, z2)
         return [(p.x, p.y, p.z) for p in line]
 
+    cpdef list build_line(self, int x1, int y1, int z1, int x2, int y2, int z2, tuple color, limit=None):
+        """
+        Build the line from (x1, y1, z1) to (x2, y2, z2) like clients do for a BlockLine: every empty point of
+        `block_line` that touches a solid voxel is placed, in order. Returns the placed voxels.
+
+        If `limit` is given and more than `limit` points are empty, nothing is built.
+        """
+        cdef:
+            size_t c_limit = SIZE_MAX if limit is None else limit
+            uint32_t c_color = block_color(*color)
+            vector[Pos3] placed
+        placed = self.map_data.build_line(x1, y1, z1, x2, y2, z2, c_color, c_limit)
+        return [(p.x, p.y, p.z) for p in placed]
+
     cpdef int get_z(self, int x, int y, int start = 0):
         return self.map_data.get_z(x, y, start)
 
+    cpdef uint32_t get_color(self, int x, int y, int z):
+        return self.map_data.get_color(x, y, z)
+
     cpdef tuple get_random_pos(self, int x1, int y1, int x2, int y2):
         cdef int x, y, z
         self.map_data.get_random_point(&x, &y, &z, x1, y1, x2, y2)
@@ -94,6 +177,47 @@ cdef class VXLMap:
         cdef vector[uint8_t] x = self.map_data.write()
         return x.data()[:x.size()]
 
+    def get_chunks(self):
+        # every chunk, same as list(self), but serialized without holding the GIL so it can run in a worker thread
+        cdef:
+            vector[uint8_t] v
+            vector[size_t] offsets
+            size_t i
+        v.reserve(5 * 1024 * 1024)
+        with nogil:
+            for i in range(MAP_CHUNKS):
+                offsets.push_back(v.size())
+                self.map_data.write_chunk(v, i)
+            offsets.push_back(v.size())
+        return [v.data()[offsets[i]:offsets[i + 1]] for i in range(MAP_CHUNKS)]
+
+    cpdef bytes get_chunk(self, size_t index):
+        # same data as the index-th item yielded by iter(self)
+        cdef vector[uint8_t] v
+        v.reserve(CHUNK_COLUMNS * 8)
+        with nogil:
+            self.map_data.write_chunk(v, index)
+        return v.data()[:v.size()]
+
+    cpdef list get_dirty_chunks(self, uint64_t since):
+        # indices of the chunks edited after revision `since`
+        return self.map_data.get_dirty_chunks(since)
+
+    def set_journaling(self, bint enabled):
+        # start (or stop and forget) recording the net change of every voxel edited from now on
+        self.map_data.set_journaling(enabled)
+
+    cpdef list get_journal(self):
+        # [(x, y, z, color)] where color is None for destroyed voxels; builds come first
+        cdef:
+            vector[JournalItem] journal = self.map_data.get_journal()
+            JournalItem item
+        return [(item.x, item.y, item.z, item.color if item.solid else None) for item in journal]
+
+    @property
+    def journal_size(self):
+        return self.map_data.get_journal_size()
+
     def width(self):
         return MAP_X
 
@@ -118,7 +242,77 @@ cdef class VXLMap:
     def __bytes__(self):
         return self.get_bytes()
 
+    def as_arrays(self):
+        """
+        Read-only buffers over the map's data, indexed [x, y] like the rest of the API. Wrap them with
+        `numpy.asarray` (or `memoryview`) to work on the whole map at once.
+
+        Returns (geometry, heights, colors):
+          geometry: uint64 per column, bit z set if the voxel is solid. Shares memory with the map.
+          heights: uint8 per column, the z of its topmost solid voxel or VXL_MAP_Z if it's empty. Shares memory with
+                   the map.
+          colors: uint32 per column, the color of its topmost solid voxel (0 if it's empty). Colors aren't stored as
+                  a dense volume, so this one is a copy of the map as it is now.
+        """
+        cdef:
+            MapArray geometry = MapArray(self, sizeof(uint64_t), b"Q")
+            MapArray heights = MapArray(self, sizeof(uint8_t), b"B")
+            MapArray colors = MapArray(self, sizeof(uint32_t), b"I")
+            const uint8_t *top = self.map_data.get_heights()
+            size_t column
+        geometry.data = self.map_data.get_geometry()
+        heights.data = top
+        colors.storage.resize(MAP_X * MAP_Y)
+        for column in range(MAP_X * MAP_Y):
+            if top[column] < MAP_Z:
+                colors.storage[column] = self.map_data.get_color(column % MAP_X, column // MAP_X, top[column])
+        colors.data = colors.storage.data()
+        return geometry, heights, colors
+
+    @property
+    def memory_usage(self):
+        return self.map_data.memory_usage()
+
+    @property
+    def revision(self):
+        return self.map_data.get_revision()
+
     @property
     def name(self):
         return self.map_info["name"]
 
+
+cdef class MapArray:
+    """
+    A read-only, column per item view of a map's data for the buffer protocol; see `VXLMap.as_arrays`. Columns are
+    stored y-major, so the [x, y] view is Fortran-ordered.
+    """
+    def __cinit__(self, VXLMap map, Py_ssize_t itemsize, bytes format):
+        self.map = map
+        self.data = NULL
+        self.itemsize = itemsize
+        self.shape[0] = MAP_X
+        self.shape[1] = MAP_Y
+        self.strides[0] = itemsize
+        self.strides[1] = itemsize * MAP_X
+        self.format = format
+
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        if flags & PyBUF_WRITABLE:
+            raise BufferError("map arrays are read-only")
+        if (flags & PyBUF_C_CONTIGUOUS) == PyBUF_C_CONTIGUOUS or (flags & PyBUF_STRIDES) != PyBUF_STRIDES:
+            raise BufferError("map arrays are indexed [x, y] and need strides")
+        buffer.buf = <void *>self.data
+        buffer.obj = self
+        buffer.len = self.itemsize * MAP_X * MAP_Y
+        buffer.readonly = 1
+        buffer.itemsize = self.itemsize
+        buffer.format = <char *>self.format if flags & PyBUF_FORMAT else NULL
+        buffer.ndim = 2
+        buffer.shape = self.shape
+        buffer.strides = self.strides
+        buffer.suboffsets = NULL
+        buffer.internal = NULL
+
+    def __releasebuffer__(self, Py_buffer *buffer):
+        pass
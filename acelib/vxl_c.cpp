@@ -1,6 +1,7 @@
 #include <random>
 #include <chrono> 
-#include <unordered_set>
+#include <algorithm>
+#include <cstring>
 
 #include "vxl_c.h"
 
@@ -14,35 +15,141 @@ void write_bytes(std::vector<uint8_t> &vec, T item) {
     vec.push_back(static_cast<uint8_t>(item >> 24));
 }
 
-AceMap::AceMap(uint8_t *buf) : eng(std::chrono::system_clock::now().time_since_epoch().count()) {
+void ColorStore::set(const size_t column, const int z, const uint32_t color) {
+    Column &c = this->columns[column];
+    const uint64_t bit = uint64_t(1) << z;
+    const size_t index = count(c.mask & (bit - 1));
+    const size_t n = count(c.mask);
+
+    if (c.mask & bit) {
+        auto begin = this->data.begin() + c.offset;
+        if (color != DEFAULT_COLOR) {
+            begin[index] = color;
+        } else {
+            std::copy(begin + index + 1, begin + n, begin + index);
+            c.mask &= ~bit;
+        }
+        return;
+    }
+    if (color == DEFAULT_COLOR) return;
+
+    if (n == c.capacity) {
+        // the column's slot is full, move it to the end with some room to grow
+        const uint32_t capacity = static_cast<uint32_t>(std::min<size_t>(n + n / 2 + 2, MAP_Z));
+        const size_t offset = this->data.size();
+        this->data.resize(offset + capacity);
+        std::copy(this->data.begin() + c.offset, this->data.begin() + c.offset + n, this->data.begin() + offset);
+        this->unused += c.capacity;
+        c.offset = static_cast<uint32_t>(offset);
+        c.capacity = capacity;
+    }
+    auto begin = this->data.begin() + c.offset;
+    std::copy_backward(begin + index, begin + n, begin + n + 1);
+    begin[index] = color;
+    c.mask |= bit;
+
+    if (this->unused > this->data.size() / 2)
+        this->compact();
+}
+
+void ColorStore::append(const size_t column, const int z, const uint32_t color) {
+    Column &c = this->columns[column];
+    // only valid while this column's slot is the last one in `data` and nothing above z is colored yet
+    if ((c.capacity && c.offset + c.capacity != this->data.size()) || (c.mask >> z)) {
+        this->set(column, z, color);
+        return;
+    }
+    if (color == DEFAULT_COLOR) return;
+    if (!c.capacity)
+        c.offset = static_cast<uint32_t>(this->data.size());
+    this->data.push_back(color);
+    c.capacity++;
+    c.mask |= uint64_t(1) << z;
+}
+
+void ColorStore::clear() {
+    std::fill(this->columns.begin(), this->columns.end(), Column{ 0, 0, 0 });
+    this->data.clear();
+    this->unused = 0;
+}
+
+size_t ColorStore::memory_usage() const {
+    return this->columns.capacity() * sizeof(Column) + this->data.capacity() * sizeof(uint32_t);
+}
+
+size_t ColorStore::size() const {
+    size_t size = 0;
+    for (const Column &c : this->columns)
+        size += count(c.mask);
+    return size;
+}
+
+void ColorStore::pack(uint64_t *masks, uint32_t *colors) const {
+    for (const Column &c : this->columns) {
+        const size_t n = count(c.mask);
+        *masks++ = c.mask;
+        colors = std::copy(this->data.begin() + c.offset, this->data.begin() + c.offset + n, colors);
+    }
+}
+
+void ColorStore::unpack(const uint64_t *masks, const uint32_t *colors, const size_t size) {
+    uint32_t offset = 0;
+    for (Column &c : this->columns) {
+        const uint32_t n = static_cast<uint32_t>(count(*masks));
+        c = Column{ *masks++, offset, n };
+        offset += n;
+    }
+    this->data.assign(colors, colors + size);
+    this->unused = 0;
+}
+
+void ColorStore::compact() {
+    std::vector<uint32_t> packed;
+    packed.reserve(this->data.size() - this->unused);
+    for (Column &c : this->columns) {
+        const size_t n = count(c.mask);
+        const uint32_t offset = static_cast<uint32_t>(packed.size());
+        packed.insert(packed.end(), this->data.begin() + c.offset, this->data.begin() + c.offset + n);
+        c.offset = offset;
+        c.capacity = static_cast<uint32_t>(n);
+    }
+    this->data.swap(packed);
+    this->unused = 0;
+}
+
+AceMap::AceMap(const uint8_t *buf) : eng(std::chrono::system_clock::now().time_since_epoch().count()),
+                             geometry(MAP_X * MAP_Y, 0), heights(MAP_X * MAP_Y, MAP_Z),
+                             spawns(SPAWN_BUCKETS_X * SPAWN_BUCKETS_Y), revision(0), chunk_revisions(MAP_CHUNKS, 0),
+                             journaling(false) {
     nodes.reserve(512);
+    runs.reserve(512);
     this->read(buf);
 }
 
-void AceMap::read(uint8_t *buf) {
+void AceMap::read(const uint8_t *buf) {
     if (!buf) return;
+    this->revision++;
+    std::fill(this->chunk_revisions.begin(), this->chunk_revisions.end(), this->revision);
+    this->journal.clear();
+    this->colors.clear();
 
     for (int y = 0; y < MAP_Y; ++y) {
         for (int x = 0; x < MAP_X; ++x) {
-            int z;
-            for (z = 0; z < MAP_Z; ++z) {
-                this->geometry[get_pos(x, y, z)] = true;
-                this->colors[get_pos(x, y, z)] = DEFAULT_COLOR;
-            }
-
+            const size_t column = get_column(x, y);
+            uint64_t solid = ~uint64_t(0);
 
-            z = 0;
+            int z = 0;
             while (true) {
                 int number_4byte_chunks = buf[0];
                 int top_color_start = buf[1];
                 int top_color_end = buf[2]; // inclusive
 
                 for (int i = z; i < top_color_start; i++)
-                    this->geometry[get_pos(x, y, i)] = false;
+                    solid &= ~(uint64_t(1) << i);
 
-                uint32_t *color = reinterpret_cast<uint32_t *>(&buf[4]);
+                const uint32_t *color = reinterpret_cast<const uint32_t *>(&buf[4]);
                 for (z = top_color_start; z <= top_color_end; z++)
-                    this->colors[get_pos(x, y, z)] = *(color++);
+                    this->colors.append(column, z, *(color++));
 
                 int len_bottom = top_color_end - top_color_start + 1;
 
@@ -63,11 +170,87 @@ void AceMap::read(uint8_t *buf) {
                 int bottom_color_start = bottom_color_end - len_top;
 
                 for (z = bottom_color_start; z < bottom_color_end; ++z) {
-                    this->colors[get_pos(x, y, z)] = *color++;
+                    this->colors.append(column, z, *color++);
                 }
             }
+            this->geometry[column] = solid;
+            this->heights[column] = static_cast<uint8_t>(solid ? count_trailing_zeros(solid) : MAP_Z);
         }
     }
+    this->reset_spawns();
+}
+
+namespace {
+    struct SnapshotHeader {
+        char magic[8];
+        uint32_t map_x, map_y, map_z;
+        uint32_t colors;
+    };
+    constexpr char SNAPSHOT_MAGIC[8] = { 'A', 'C', 'E', 'M', 'A', 'P', '0', '1' };
+    constexpr size_t COLUMNS = MAP_X * MAP_Y;
+}
+
+std::vector<uint8_t> AceMap::write_snapshot() const {
+    // geometry masks, color masks, colors, heights
+    SnapshotHeader header;
+    std::copy(SNAPSHOT_MAGIC, SNAPSHOT_MAGIC + 8, header.magic);
+    header.map_x = MAP_X; header.map_y = MAP_Y; header.map_z = MAP_Z;
+    header.colors = static_cast<uint32_t>(this->colors.size());
+
+    std::vector<uint8_t> v(sizeof(header) + COLUMNS * (2 * sizeof(uint64_t) + 1) + header.colors * sizeof(uint32_t));
+    uint8_t *p = v.data();
+    std::memcpy(p, &header, sizeof(header));
+    p += sizeof(header);
+    std::memcpy(p, this->geometry.data(), COLUMNS * sizeof(uint64_t));
+    p += COLUMNS * sizeof(uint64_t);
+    std::vector<uint64_t> masks(COLUMNS);
+    std::vector<uint32_t> colors(header.colors);
+    this->colors.pack(masks.data(), colors.data());
+    std::memcpy(p, masks.data(), COLUMNS * sizeof(uint64_t));
+    p += COLUMNS * sizeof(uint64_t);
+    std::memcpy(p, colors.data(), colors.size() * sizeof(uint32_t));
+    p += colors.size() * sizeof(uint32_t);
+    std::memcpy(p, this->heights.data(), COLUMNS);
+    return v;
+}
+
+bool AceMap::read_snapshot(const uint8_t *buf, const size_t size) {
+    SnapshotHeader header;
+    if (size < sizeof(header)) return false;
+    std::memcpy(&header, buf, sizeof(header));
+    if (!std::equal(SNAPSHOT_MAGIC, SNAPSHOT_MAGIC + 8, header.magic) ||
+        header.map_x != MAP_X || header.map_y != MAP_Y || header.map_z != MAP_Z ||
+        size != sizeof(header) + COLUMNS * (2 * sizeof(uint64_t) + 1) + size_t(header.colors) * sizeof(uint32_t))
+        return false;
+
+    this->revision++;
+    std::fill(this->chunk_revisions.begin(), this->chunk_revisions.end(), this->revision);
+    this->journal.clear();
+
+    // the buffer is usually a memory-mapped file, so copy out of it instead of casting (it may not be aligned)
+    buf += sizeof(header);
+    std::memcpy(this->geometry.data(), buf, COLUMNS * sizeof(uint64_t));
+    buf += COLUMNS * sizeof(uint64_t);
+    std::vector<uint64_t> masks(COLUMNS);
+    std::vector<uint32_t> colors(header.colors);
+    std::memcpy(masks.data(), buf, COLUMNS * sizeof(uint64_t));
+    buf += COLUMNS * sizeof(uint64_t);
+    std::memcpy(colors.data(), buf, colors.size() * sizeof(uint32_t));
+    buf += colors.size() * sizeof(uint32_t);
+    this->colors.unpack(masks.data(), colors.data(), colors.size());
+    std::memcpy(this->heights.data(), buf, COLUMNS);
+    this->reset_spawns();
+    return true;
+}
+
+void AceMap::reset_spawns() {
+    for (size_t by = 0; by < SPAWN_BUCKETS_Y; by++) {
+        for (size_t bx = 0; bx < SPAWN_BUCKETS_X; bx++) {
+            this->spawns[bx + by * SPAWN_BUCKETS_X].dirty = true;
+            this->get_spawn_bucket(bx, by);
+        }
+    }
+    this->spawn_areas.clear();
 }
 
 std::vector<uint8_t> AceMap::write() {
@@ -89,21 +272,26 @@ size_t AceMap::write(std::vector<uint8_t> &v, int *sx, int *sy, int columns) {
             if (!all && column >= columns) {
                 goto done;
             }
+            const size_t index = get_column(x, y);
+            const uint64_t solid = this->geometry[index], surface = this->get_surface(x, y);
+            auto solid_at = [solid](int z) { return z < MAP_Z && ((solid >> z) & 1); };
+            auto surface_at = [surface](int z) { return z < MAP_Z && ((surface >> z) & 1); };
+
             int z = 0;
             while (z < MAP_Z) {
                 // find the air region
                 int air_start = z;
-                while (z < MAP_Z && !this->geometry[get_pos(x, y, z)])
+                while (z < MAP_Z && !solid_at(z))
                     ++z;
 
                 // find the top region
                 int top_colors_start = z;
-                while (z < MAP_Z && this->is_surface(x, y, z))
+                while (surface_at(z))
                     ++z;
                 int top_colors_end = z;
 
                 // now skip past the solid voxels
-                while (z < MAP_Z && this->geometry[get_pos(x, y, z)] && !this->is_surface(x, y, z))
+                while (solid_at(z) && !surface_at(z))
                     ++z;
 
                 // at the end of the solid voxels, we have colored voxels.
@@ -115,12 +303,12 @@ size_t AceMap::write(std::vector<uint8_t> &v, int *sx, int *sy, int columns) {
                 int bottom_colors_start = z;
 
                 int i = z;
-                while (i < MAP_Z && this->is_surface(x, y, i))
+                while (surface_at(i))
                     ++i;
 
                 if (i != MAP_Z) {
                     // these are real bottom colors so we can write them
-                    while (is_surface(x, y, z))
+                    while (surface_at(z))
                         ++z;
                 }
                 int bottom_colors_end = z;
@@ -141,10 +329,10 @@ size_t AceMap::write(std::vector<uint8_t> &v, int *sx, int *sy, int columns) {
                 v.push_back(air_start);
 
                 for (i = 0; i < top_colors_len; ++i)
-                    write_bytes(v, this->colors[get_pos(x, y, top_colors_start + i)]);
-                    
+                    write_bytes(v, this->colors.get(index, top_colors_start + i));
+
                 for (i = 0; i < bottom_colors_len; ++i)
-                    write_bytes(v, this->colors[get_pos(x, y, bottom_colors_start + i)]);
+                    write_bytes(v, this->colors.get(index, bottom_colors_start + i));
             }
             column++;
         }
@@ -156,15 +344,119 @@ done:
     return v.size() - initial_size;
 }
 
+size_t AceMap::write_chunk(std::vector<uint8_t> &v, size_t chunk) {
+    if (chunk >= MAP_CHUNKS) return 0;
+    int x = (chunk * CHUNK_COLUMNS) % MAP_X;
+    int y = (chunk * CHUNK_COLUMNS) / MAP_X;
+    return this->write(v, &x, &y, CHUNK_COLUMNS);
+}
+
+std::vector<size_t> AceMap::get_dirty_chunks(uint64_t since) const {
+    std::vector<size_t> chunks;
+    for (size_t i = 0; i < MAP_CHUNKS; i++) {
+        if (this->chunk_revisions[i] > since)
+            chunks.push_back(i);
+    }
+    return chunks;
+}
+
+void AceMap::mark_dirty(const int x, const int y) {
+    // a column's serialization depends on which of its voxels are surface, so the 4 neighbouring columns change too
+    static constexpr int offsets[5][2] = { {0, 0}, {-1, 0}, {1, 0}, {0, -1}, {0, 1} };
+    for (auto &offset : offsets) {
+        const int cx = x + offset[0], cy = y + offset[1];
+        if (cx < 0 || cx >= MAP_X || cy < 0 || cy >= MAP_Y) continue;
+        this->chunk_revisions[(cx + cy * MAP_X) / CHUNK_COLUMNS] = this->revision;
+    }
+}
+
+void AceMap::set_journaling(bool enabled) {
+    this->journaling = enabled;
+    if (!enabled)
+        this->journal.clear();
+}
+
+std::vector<JournalItem> AceMap::get_journal() const {
+    std::vector<JournalItem> items;
+    items.reserve(this->journal.size());
+    for (auto &it : this->journal) {
+        const Pos3 p = get_xyz(it.first);
+        items.push_back({ p.x, p.y, p.z, it.second.solid, it.second.color });
+    }
+    // builds first (bottom up), so replaying destroys (top down) never leaves anything without support
+    std::sort(items.begin(), items.end(), [](const JournalItem &a, const JournalItem &b) {
+        if (a.solid != b.solid) return a.solid;
+        if (a.z != b.z) return a.solid ? a.z > b.z : a.z < b.z;
+        if (a.y != b.y) return a.y < b.y;
+        return a.x < b.x;
+    });
+    return items;
+}
+
+namespace {
+    template<typename T>
+    size_t capacity_bytes(const std::vector<T> &v) {
+        return v.capacity() * sizeof(T);
+    }
+
+    // buckets, plus a node holding the next pointer and the cached hash with every element
+    template<typename K, typename V>
+    size_t table_bytes(const std::unordered_map<K, V> &m) {
+        return m.bucket_count() * sizeof(void *) + m.size() * (sizeof(std::pair<const K, V>) + 2 * sizeof(void *));
+    }
+}
+
+size_t AceMap::memory_usage() const {
+    size_t total = sizeof(*this) + this->colors.memory_usage();
+    total += capacity_bytes(this->geometry) + capacity_bytes(this->heights) + capacity_bytes(this->chunk_revisions);
+
+    total += capacity_bytes(this->nodes) + capacity_bytes(this->seeds) + capacity_bytes(this->runs) +
+             capacity_bytes(this->visited) + capacity_bytes(this->grounded) + capacity_bytes(this->grounded_columns);
+    total += capacity_bytes(this->job.nodes) + capacity_bytes(this->job.runs) + capacity_bytes(this->job.visited);
+    total += this->deferred.size() * sizeof(Pos3);
+
+    total += capacity_bytes(this->spawns);
+    for (const SpawnBucket &bucket : this->spawns)
+        total += capacity_bytes(bucket.cells);
+    total += table_bytes(this->spawn_areas);
+    for (const auto &it : this->spawn_areas)
+        total += capacity_bytes(it.second.offsets);
+
+    total += table_bytes(this->journal);
+    return total;
+}
+
+void AceMap::record(const size_t pos, const bool solid, const uint32_t color) {
+    auto it = this->journal.find(pos);
+    if (it == this->journal.end()) {
+        const bool base_solid = this->get_solid(pos);
+        const uint32_t base_color = this->get_color(pos);
+        it = this->journal.insert({ pos, { base_solid, base_solid, base_color, base_color } }).first;
+    }
+
+    JournalEntry &entry = it->second;
+    entry.solid = solid;
+    entry.color = color;
+    // edits that cancel out (i.e. building then destroying a block in empty space) don't need replaying
+    if (entry.solid == entry.base_solid && (!entry.solid || entry.color == entry.base_color))
+        this->journal.erase(it);
+}
+
+uint64_t AceMap::get_surface(const int x, const int y) const {
+    const size_t column = get_column(x, y);
+    const uint64_t solid = this->geometry[column];
+    // bit z of each mask is set if that neighbour of voxel z is solid (or off the edge of the map)
+    uint64_t covered = (solid << 1 | 1) & (solid >> 1 | uint64_t(1) << (MAP_Z - 1));
+    if (x     >     0) covered &= this->geometry[column - 1];
+    if (x + 1 < MAP_X) covered &= this->geometry[column + 1];
+    if (y     >     0) covered &= this->geometry[column - MAP_X];
+    if (y + 1 < MAP_Y) covered &= this->geometry[column + MAP_X];
+    return solid & ~covered;
+}
+
 bool AceMap::is_surface(const int x, const int y, const int z) {
-    if (!this->geometry[get_pos(x, y, z)]) return false;
-    if (x     >     0 && !this->geometry[get_pos(x - 1, y, z)]) return true;
-    if (x + 1 < MAP_X && !this->geometry[get_pos(x + 1, y, z)]) return true;
-    if (y     >     0 && !this->geometry[get_pos(x, y - 1, z)]) return true;
-    if (y + 1 < MAP_Y && !this->geometry[get_pos(x, y + 1, z)]) return true;
-    if (z     >     0 && !this->geometry[get_pos(x, y, z - 1)]) return true;
-    if (z + 1 < MAP_Z && !this->geometry[get_pos(x, y, z + 1)]) return true;
-    return false;
+    if (!is_valid_pos(x, y, z)) return false;
+    return (this->get_surface(x, y) >> z) & 1;
 }
 
 bool AceMap::get_solid(int x, int y, int z, bool wrapped) {
@@ -174,7 +466,7 @@ bool AceMap::get_solid(int x, int y, int z, bool wrapped) {
     }
     if (!is_valid_pos(x, y, z))
         return false;
-    return this->geometry[get_pos(x, y, z)];
+    return (this->geometry[get_column(x, y)] >> z) & 1;
 }
 
 uint32_t AceMap::get_color(int x, int y, int z, bool wrapped) {
@@ -183,17 +475,23 @@ uint32_t AceMap::get_color(int x, int y, int z, bool wrapped) {
         y &= (MAP_Y - 1);
     }
     if (!is_valid_pos(x, y, z)) return 0;
-    return this->colors[get_pos(x, y, z)];
+    return this->colors.get(get_column(x, y), z);
 }
 
 int AceMap::get_z(const int x, const int y, const int start) {
-    for(int z = start; z < MAP_Z; z++) {
-        if (this->get_solid(x, y, z)) return z;
-    }
-    return MAP_Z;
+    if (!is_valid_pos(x, y, 0) || start >= MAP_Z) return MAP_Z;
+    const size_t column = get_column(x, y);
+    const int top = this->heights[column];
+    if (start <= top) return top;
+    const uint64_t solid = this->geometry[column] & (~uint64_t(0) << start);
+    return solid ? count_trailing_zeros(solid) : MAP_Z;
 }
 
 void AceMap::get_random_point(int *x, int *y, int *z, int x1, int y1, int x2, int y2) {
+    if (this->get_spawn_point(x, y, z, x1, y1, x2, y2))
+        return;
+
+    // nowhere to stand in the area, fall back to any point in it
     std::uniform_int_distribution<int> xdist(x1, x2 - 1);
     std::uniform_int_distribution<int> ydist(y1, y2 - 1);
 
@@ -207,6 +505,92 @@ void AceMap::get_random_point(int *x, int *y, int *z, int x1, int y1, int x2, in
     *x = rx; *y = ry; *z = rz;
 }
 
+AceMap::SpawnBucket &AceMap::get_spawn_bucket(const size_t bx, const size_t by) {
+    SpawnBucket &bucket = this->spawns[bx + by * SPAWN_BUCKETS_X];
+    if (bucket.dirty) {
+        bucket.cells.clear();
+        for (int cell = 0; cell < SPAWN_BUCKET * SPAWN_BUCKET; cell++) {
+            const size_t column = get_column(static_cast<int>(bx * SPAWN_BUCKET) + cell % SPAWN_BUCKET,
+                                             static_cast<int>(by * SPAWN_BUCKET) + cell / SPAWN_BUCKET);
+            if (this->is_spawnable(column))
+                bucket.cells.push_back(static_cast<uint8_t>(cell));
+        }
+        bucket.dirty = false;
+    }
+    return bucket;
+}
+
+bool AceMap::get_spawn_point(int *x, int *y, int *z, int x1, int y1, int x2, int y2) {
+    x1 = std::max(x1, 0); y1 = std::max(y1, 0);
+    x2 = std::min(x2, static_cast<int>(MAP_X)); y2 = std::min(y2, static_cast<int>(MAP_Y));
+    if (x1 >= x2 || y1 >= y2) return false;
+    const size_t bx1 = x1 / SPAWN_BUCKET, by1 = y1 / SPAWN_BUCKET;
+    const size_t bx2 = (x2 - 1) / SPAWN_BUCKET, by2 = (y2 - 1) / SPAWN_BUCKET;
+    const size_t width = bx2 - bx1 + 1;
+
+    // game modes only ever ask for a handful of areas, anything past that is somebody's one-off
+    if (this->spawn_areas.size() > 64)
+        this->spawn_areas.clear();
+    const uint64_t key = uint64_t(x1) | uint64_t(y1) << 16 | uint64_t(x2) << 32 | uint64_t(y2) << 48;
+    SpawnArea &area = this->spawn_areas[key];
+    if (area.offsets.empty() || area.edits != this->spawn_edits) {
+        area.offsets.clear();
+        uint32_t total = 0;
+        for (size_t by = by1; by <= by2; by++) {
+            for (size_t bx = bx1; bx <= bx2; bx++) {
+                area.offsets.push_back(total);
+                total += static_cast<uint32_t>(this->get_spawn_bucket(bx, by).cells.size());
+            }
+        }
+        area.offsets.push_back(total);
+        area.edits = this->spawn_edits;
+    }
+    const uint32_t total = area.offsets.back();
+    if (!total) return false;
+
+    const auto get_cell = [&](const size_t bucket, const uint8_t cell) {
+        const size_t bx = bx1 + bucket % width, by = by1 + bucket / width;
+        return get_column(static_cast<int>(bx * SPAWN_BUCKET) + cell % SPAWN_BUCKET,
+                          static_cast<int>(by * SPAWN_BUCKET) + cell / SPAWN_BUCKET);
+    };
+    const auto get_cells = [&](const size_t bucket) -> const std::vector<uint8_t> & {
+        return this->spawns[bx1 + bucket % width + (by1 + bucket / width) * SPAWN_BUCKETS_X].cells;
+    };
+    const auto inside = [&](const size_t column) {
+        const int cx = static_cast<int>(column % MAP_X), cy = static_cast<int>(column / MAP_X);
+        return cx >= x1 && cx < x2 && cy >= y1 && cy < y2;
+    };
+    const auto pick = [&](const size_t column) {
+        *x = static_cast<int>(column % MAP_X); *y = static_cast<int>(column / MAP_X); *z = this->heights[column];
+    };
+
+    // buckets on the edges of the area can hold cells outside of it. drawing again until the cell is inside keeps
+    // the pick uniform, and areas much bigger than a bucket rarely need a second draw
+    std::uniform_int_distribution<uint32_t> dist(0, total - 1);
+    for (int attempt = 0; attempt < 16; attempt++) {
+        const uint32_t i = dist(this->eng);
+        const size_t bucket = std::upper_bound(area.offsets.begin(), area.offsets.end(), i) - area.offsets.begin() - 1;
+        const size_t column = get_cell(bucket, get_cells(bucket)[i - area.offsets[bucket]]);
+        if (inside(column)) {
+            pick(column);
+            return true;
+        }
+    }
+
+    // a small area that doesn't fill its buckets: go through every cell actually inside it instead
+    std::vector<size_t> columns;
+    for (size_t bucket = 0; bucket + 1 < area.offsets.size(); bucket++) {
+        for (const uint8_t cell : get_cells(bucket)) {
+            const size_t column = get_cell(bucket, cell);
+            if (inside(column))
+                columns.push_back(column);
+        }
+    }
+    if (columns.empty()) return false;
+    pick(columns[std::uniform_int_distribution<size_t>(0, columns.size() - 1)(this->eng)]);
+    return true;
+}
+
 std::vector<Pos3> AceMap::get_neighbors(int x, int y, int z) {
     std::vector<Pos3> neighbors;
     this->add_neighbors(neighbors, x, y, z);
@@ -292,6 +676,33 @@ std::vector<Pos3> AceMap::block_line(int x1, int y1, int z1, int x2, int y2, int
     return ret;
 }
 
+std::vector<Pos3> AceMap::build_line(int x1, int y1, int z1, int x2, int y2, int z2, uint32_t color, size_t limit) {
+    std::vector<Pos3> line = this->block_line(x1, y1, z1, x2, y2, z2);
+
+    // the bottom layers can't be built on, same as VXLMap.can_build
+    const auto buildable = [this](const Pos3 &p) {
+        return is_valid_pos(p.x, p.y, p.z) && p.z < MAP_Z - 2 &&
+               !((this->geometry[get_column(p.x, p.y)] >> p.z) & 1);
+    };
+    // clients take a line they don't have the blocks for as a whole, so there's no partial line to build
+    size_t empty = 0;
+    for (const Pos3 &p : line)
+        empty += buildable(p);
+    if (!empty || empty > limit)
+        return {};
+
+    // every point needs something to stick to, which can be the point placed just before it
+    size_t placed = 0;
+    for (const Pos3 &p : line) {
+        if (!buildable(p) || !this->touches(this->geometry, get_column(p.x, p.y), p.z))
+            continue;
+        this->set_point(p.x, p.y, p.z, true, color);
+        line[placed++] = p;
+    }
+    line.resize(placed);
+    return line;
+}
+
 bool AceMap::set_point(const int x, const int y, const int z, const bool solid, const uint32_t color) {
     return this->set_point(get_pos(x, y, z), solid, color);
 }
@@ -299,36 +710,252 @@ bool AceMap::set_point(const int x, const int y, const int z, const bool solid,
 bool AceMap::set_point(const size_t pos, const bool solid, const uint32_t color) {
     if (!is_valid_pos(pos)) return false;
 
-    this->geometry[pos] = solid;
-    this->colors[pos] = solid ? color : DEFAULT_COLOR;
+    if (this->journaling)
+        this->record(pos, solid, solid ? color : DEFAULT_COLOR);
+    const size_t column = pos / MAP_Z;
+    const int z = static_cast<int>(pos % MAP_Z);
+    const int top = this->heights[column];
+    if (solid) {
+        this->geometry[column] |= uint64_t(1) << z;
+        if (z < top) this->set_height(column, z);
+        // a block built against a structure that's being checked joins it, and may be what holds it up now
+        if (this->job.state == CollapseJob::SEARCHING && this->touches(this->job.visited, column, z))
+            this->job.nodes.push_back({ column, z });
+    } else {
+        this->geometry[column] &= ~(uint64_t(1) << z);
+        this->forget_grounded();
+        if (z == top) {
+            const uint64_t rest = this->geometry[column];
+            this->set_height(column, rest ? count_trailing_zeros(rest) : MAP_Z);
+        }
+    }
+    this->colors.set(column, z, solid ? color : DEFAULT_COLOR);
+    this->revision++;
+    const Pos3 p = get_xyz(pos);
+    this->mark_dirty(p.x, p.y);
     return true;
 }
 
-bool AceMap::check_node(int x, int y, int z, bool destroy) {
-    marked.clear();
-    nodes.clear();
-    nodes.push_back({x, y, z});
-
+AceMap::Support AceMap::search(std::vector<Node> &nodes, std::vector<Run> &runs, std::vector<uint64_t> &visited,
+                               size_t &budget, const bool use_grounded) {
+    // flood fills whole vertical runs of solid voxels at a time, so reaching the bottom layers through a column costs
+    // one step. runs touching the bottom layers (or known grounded ones) end the search. every run visited takes one
+    // off the budget, if there's one; the search can be picked up again from `nodes` once it runs out
     while (!nodes.empty()) {
-        const Pos3 &node = nodes.back();
-        x = node.x; y = node.y; z = node.z;
+        if (budget == 1)
+            return UNKNOWN;
+        if (budget)
+            budget--;
+
+        const Node node = nodes.back();
         nodes.pop_back();
-        if (z >= 62) {
-            return true;
-        }
 
-        // already visited?
-        auto ret = marked.insert(get_pos(x, y, z));
-        if (ret.second) {
-            this->add_neighbors(nodes, x, y, z);
-        }
+        const uint64_t solid = this->geometry[node.column];
+        if (!(((solid & ~visited[node.column]) >> node.z) & 1))
+            continue;
+
+        const uint64_t run = get_run(solid, node.z);
+        runs.push_back({ node.column, run });
+        visited[node.column] |= run;
+        if ((run >> (MAP_Z - 2)) || (use_grounded && (this->grounded[node.column] & run)))
+            return GROUNDED;
+
+        // queue every run in the neighbouring columns that touches this one. the lowest ones are pushed last so
+        // they're visited first
+        auto add_runs = [this, run, &nodes, &visited](const size_t column) {
+            const uint64_t solid = this->geometry[column];
+            uint64_t touching = solid & run & ~visited[column];
+            while (touching) {
+                const int z = count_trailing_zeros(touching);
+                nodes.push_back({ column, z });
+                touching &= ~get_run(solid, z);
+            }
+        };
+        const size_t cx = node.column % MAP_X, cy = node.column / MAP_X;
+        if (cx     >     0) add_runs(node.column - 1);
+        if (cx + 1 < MAP_X) add_runs(node.column + 1);
+        if (cy     >     0) add_runs(node.column - MAP_X);
+        if (cy + 1 < MAP_Y) add_runs(node.column + MAP_X);
+    }
+    return FLOATING;
+}
+
+AceMap::Support AceMap::find_ground(const int x, const int y, const int z, const bool use_grounded, const size_t limit) {
+    // the budget counts down to 1 so that 0 can mean no limit
+    size_t budget = limit ? limit + 1 : 0;
+    return this->find_ground_budget(x, y, z, use_grounded, budget);
+}
+
+AceMap::Support AceMap::find_ground_budget(const int x, const int y, const int z, const bool use_grounded, size_t &budget) {
+    if (this->visited.empty()) {
+        this->visited.assign(MAP_X * MAP_Y, 0);
+        this->grounded.assign(MAP_X * MAP_Y, 0);
+    }
+    this->runs.clear();
+    this->nodes.clear();
+    this->nodes.push_back({ get_column(x, y), z });
+
+    const Support support = this->search(this->nodes, this->runs, this->visited, budget, use_grounded);
+    for (const Run &r : this->runs)
+        this->visited[r.column] = 0;
+    return support;
+}
+
+void AceMap::destroy_run(const size_t column, uint64_t mask) {
+    // voxels may have been destroyed since they were found
+    mask &= this->geometry[column];
+    if (!mask) return;
+
+    for (uint64_t bits = mask; bits; bits &= bits - 1) {
+        const int z = count_trailing_zeros(bits);
+        if (this->journaling)
+            this->record(column * MAP_Z + z, false, DEFAULT_COLOR);
+        this->colors.set(column, z, DEFAULT_COLOR);
     }
+    const uint64_t solid = this->geometry[column] &= ~mask;
+    this->set_height(column, solid ? count_trailing_zeros(solid) : MAP_Z);
+    this->revision++;
+    this->mark_dirty(static_cast<int>(column % MAP_X), static_cast<int>(column / MAP_X));
+}
+
+bool AceMap::check_node(int x, int y, int z, bool destroy) {
+    if (!this->get_solid(x, y, z) || this->find_ground(x, y, z) == GROUNDED)
+        return true;
 
     // destroy the node's path!
     if (destroy) {
-        for(auto pos : marked) {
-            this->set_point(pos, false, 0);
+        for (const Run &r : this->runs) {
+            this->destroy_run(r.column, r.mask);
         }
     }
     return true;
-}
\ No newline at end of file
+}
+
+std::vector<Pos3> AceMap::destroy_points(const std::vector<Pos3> &points, const size_t limit,
+                                         std::vector<Pos3> *destroyed) {
+    std::vector<Pos3> collapsed;
+
+    for (const Pos3 &p : points) {
+        if (p.z < MAP_Z - 2 && this->get_solid(p.x, p.y, p.z)) {
+            this->set_point(p.x, p.y, p.z, false, 0);
+            if (destroyed)
+                destroyed->push_back(p);
+        }
+    }
+    this->seeds.clear();
+    for (const Pos3 &p : points) {
+        if (is_valid_pos(p.x, p.y, p.z) && p.z < MAP_Z - 2)
+            this->add_neighbors(this->seeds, p.x, p.y, p.z);
+    }
+
+    // one pass over all the seeds: voxels found to be grounded stay marked, so every structure is walked at most once.
+    // all the seeds share one budget, and whichever are left once it runs out are deferred
+    size_t budget = limit ? limit + 1 : 0;
+    for (const Pos3 &seed : this->seeds) {
+        // already collapsed from another seed, or part of the bottom layers
+        if (seed.z >= MAP_Z - 2 || !this->get_solid(seed.x, seed.y, seed.z))
+            continue;
+
+        const Support support = this->find_ground_budget(seed.x, seed.y, seed.z, true, budget);
+        if (support == UNKNOWN) {
+            this->deferred.push_back(seed);
+            continue;
+        }
+        if (support == GROUNDED) {
+            this->mark_grounded(this->runs);
+            continue;
+        }
+        for (const Run &r : this->runs) {
+            const int x = static_cast<int>(r.column % MAP_X), y = static_cast<int>(r.column / MAP_X);
+            for (uint64_t bits = r.mask & this->geometry[r.column]; bits; bits &= bits - 1)
+                collapsed.push_back({ x, y, count_trailing_zeros(bits) });
+            this->destroy_run(r.column, r.mask);
+        }
+    }
+    return collapsed;
+}
+
+void AceMap::mark_grounded(const std::vector<Run> &runs) {
+    for (const Run &r : runs) {
+        if (!this->grounded[r.column])
+            this->grounded_columns.push_back(r.column);
+        this->grounded[r.column] |= r.mask;
+    }
+}
+
+void AceMap::forget_grounded() {
+    for (const size_t column : this->grounded_columns)
+        this->grounded[column] = 0;
+    this->grounded_columns.clear();
+    this->removals++;
+}
+
+std::vector<Pos3> AceMap::step_collapses(size_t limit) {
+    std::vector<Pos3> collapsed;
+    CollapseJob &job = this->job;
+    // the budget counts down to 1 so that 0 can mean no limit
+    size_t budget = limit ? limit + 1 : 0;
+
+    while (budget != 1) {
+        if (job.state == CollapseJob::IDLE) {
+            if (this->deferred.empty())
+                break;
+            const Pos3 seed = this->deferred.front();
+            this->deferred.pop_front();
+            if (seed.z >= MAP_Z - 2 || !this->get_solid(seed.x, seed.y, seed.z))
+                continue;
+
+            if (job.visited.empty())
+                job.visited.assign(MAP_X * MAP_Y, 0);
+            if (this->grounded.empty())
+                this->grounded.assign(MAP_X * MAP_Y, 0);
+            job.nodes.assign(1, { get_column(seed.x, seed.y), seed.z });
+            job.runs.clear();
+            job.removals = this->removals;
+            job.state = CollapseJob::SEARCHING;
+        }
+
+        if (job.state == CollapseJob::SEARCHING) {
+            const Support support = this->search(job.nodes, job.runs, job.visited, budget, true);
+            if (support == UNKNOWN)
+                break;
+            if (support == GROUNDED) {
+                // so later checks in the same structure stop as soon as they reach it
+                if (job.removals == this->removals)
+                    this->mark_grounded(job.runs);
+                this->end_job();
+                continue;
+            }
+            job.state = CollapseJob::COLLAPSING;
+            job.collapsed = 0;
+        }
+
+        // collapsing is spread out too, a run at a time
+        while (job.collapsed < job.runs.size() && budget != 1) {
+            if (budget)
+                budget--;
+            const Run &r = job.runs[job.collapsed++];
+            const int x = static_cast<int>(r.column % MAP_X), y = static_cast<int>(r.column / MAP_X);
+            for (uint64_t bits = r.mask & this->geometry[r.column]; bits; bits &= bits - 1)
+                collapsed.push_back({ x, y, count_trailing_zeros(bits) });
+            this->destroy_run(r.column, r.mask);
+        }
+        if (job.collapsed == job.runs.size())
+            this->end_job();
+    }
+    return collapsed;
+}
+
+void AceMap::end_job() {
+    // other deferred checks in the structure this one went through have the same answer, so they're done too: either
+    // it's grounded, or it was just collapsed
+    const std::vector<uint64_t> &visited = this->job.visited;
+    const auto resolved = [&visited](const Pos3 &p) { return (visited[get_column(p.x, p.y)] >> p.z) & 1; };
+    this->deferred.erase(std::remove_if(this->deferred.begin(), this->deferred.end(), resolved), this->deferred.end());
+
+    for (const Run &r : this->job.runs)
+        this->job.visited[r.column] = 0;
+    this->job.nodes.clear();
+    this->job.runs.clear();
+    this->job.state = CollapseJob::IDLE;
+}
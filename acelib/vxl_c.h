@@ -2,8 +2,12 @@
 #include <bitset>
 #include <stdint.h>
 #include <vector>
-#include <unordered_set>
+#include <deque>
+#include <unordered_map>
 #include <random>
+#ifdef _MSC_VER
+#include <intrin.h>
+#endif
 
 struct Pos3 {
     int x, y, z;
@@ -13,9 +17,57 @@ constexpr size_t MAP_X = 512;
 constexpr size_t MAP_Y = 512;
 constexpr size_t MAP_Z = 64;
 constexpr uint32_t DEFAULT_COLOR = 0xFF674028;
+// columns per serialized chunk, see AceMap::write_chunk
+constexpr size_t CHUNK_COLUMNS = 128;
+constexpr size_t MAP_CHUNKS = MAP_X * MAP_Y / CHUNK_COLUMNS;
+// side of the square areas the spawn index is bucketed by, see AceMap::get_random_point
+constexpr int SPAWN_BUCKET = 16;
+constexpr size_t SPAWN_BUCKETS_X = MAP_X / SPAWN_BUCKET;
+constexpr size_t SPAWN_BUCKETS_Y = MAP_Y / SPAWN_BUCKET;
+
+// voxels are laid out column by column with z fastest, so a whole column of geometry fits in one word
+static_assert(MAP_Z == 64, "columns are stored as 64-bit masks");
+
+constexpr size_t get_column(const int x, const int y) {
+    return x + y * MAP_X;
+}
 
 constexpr size_t get_pos(const int x, const int y, const int z) {
-    return x + (y * MAP_Y) + (z * MAP_X * MAP_Y);
+    return z + get_column(x, y) * MAP_Z;
+}
+
+inline Pos3 get_xyz(const size_t pos) {
+    const size_t column = pos / MAP_Z;
+    return { static_cast<int>(column % MAP_X), static_cast<int>(column / MAP_X), static_cast<int>(pos % MAP_Z) };
+}
+
+inline int count_trailing_zeros(const uint64_t v) {
+#ifdef _MSC_VER
+    unsigned long index;
+    _BitScanForward64(&index, v);
+    return static_cast<int>(index);
+#else
+    return __builtin_ctzll(v);
+#endif
+}
+
+inline int count_leading_zeros(const uint64_t v) {
+#ifdef _MSC_VER
+    unsigned long index;
+    _BitScanReverse64(&index, v);
+    return 63 - static_cast<int>(index);
+#else
+    return __builtin_clzll(v);
+#endif
+}
+
+// the contiguous run of set bits in `mask` that contains bit z (which must be set)
+inline uint64_t get_run(const uint64_t mask, const int z) {
+    const uint64_t gaps_after = ~mask & (~uint64_t(0) << z);
+    const uint64_t gaps_before = ~mask & ((uint64_t(1) << z) - 1);
+    const uint64_t end = gaps_after ? (uint64_t(1) << count_trailing_zeros(gaps_after)) - 1 : ~uint64_t(0);
+    const uint64_t start = gaps_before ? ~uint64_t(0) << (64 - count_leading_zeros(gaps_before)) : ~uint64_t(0);
+    return start & end;
 }
 
 constexpr bool is_valid_pos(const int x, const int y, const int z) {
@@ -26,13 +78,63 @@ constexpr bool is_valid_pos(const int pos) {
     return pos >= get_pos(0, 0, 0) && pos <= get_pos(MAP_X - 1, MAP_Y - 1, MAP_Z - 1);
 }
 
+// voxel colors, stored sparsely: only voxels that aren't DEFAULT_COLOR (in practice, about the map's surface) take
+// up space. each column has a mask of which of its voxels are colored and a slot in `data` with their colors in z order
+class ColorStore {
+public:
+    ColorStore() : columns(MAP_X * MAP_Y), unused(0) {}
+
+    uint32_t get(const size_t column, const int z) const {
+        const Column &c = this->columns[column];
+        const uint64_t bit = uint64_t(1) << z;
+        if (!(c.mask & bit)) return DEFAULT_COLOR;
+        return this->data[c.offset + count(c.mask & (bit - 1))];
+    }
+
+    void set(const size_t column, const int z, const uint32_t color);
+    // faster set for filling the store column by column in increasing z order, e.g. when reading a map
+    void append(const size_t column, const int z, const uint32_t color);
+    void clear();
+    size_t memory_usage() const;
+    // how many colors are stored, i.e. the size of the packed data `pack` writes
+    size_t size() const;
+    // every column's mask, and the colors of all columns in order with no room left between them
+    void pack(uint64_t *masks, uint32_t *colors) const;
+    void unpack(const uint64_t *masks, const uint32_t *colors, const size_t size);
+
+private:
+    struct Column {
+        uint64_t mask;
+        uint32_t offset, capacity;
+    };
+    std::vector<Column> columns;
+    std::vector<uint32_t> data;
+    // slots in `data` that columns have moved out of
+    size_t unused;
+
+    static size_t count(const uint64_t mask) { return std::bitset<64>(mask).count(); }
+    void compact();
+};
+
+struct JournalEntry {
+    bool base_solid, solid;
+    uint32_t base_color, color;
+};
+
+struct JournalItem {
+    int x, y, z;
+    bool solid;
+    uint32_t color;
+};
+
 
 class AceMap {
 public:
-    AceMap(uint8_t *buf = nullptr);
-    void read(uint8_t *buf);
+    AceMap(const uint8_t *buf = nullptr);
+    void read(const uint8_t *buf);
     std::vector<uint8_t> write();
     size_t write(std::vector<uint8_t> &v, int *sx, int *sy, int columns=-1);
+    size_t write_chunk(std::vector<uint8_t> &v, size_t chunk);
 
     bool is_surface(const int x, const int y, const int z);
     bool get_solid(int x, int y, int z, bool wrapped=false);
@@ -41,22 +143,170 @@ public:
     void get_random_point(int *x, int *y, int *z, int x1, int y1, int x2, int y2);
     std::vector<Pos3> get_neighbors(int x, int y, int z);
     std::vector<Pos3> block_line(int x1, int y1, int z1, int x2, int y2, int z2) const;
+    // builds the empty points of block_line that touch a solid voxel, in order, unless there are more than `limit` of
+    // them. returns the placed voxels
+    std::vector<Pos3> build_line(int x1, int y1, int z1, int x2, int y2, int z2, uint32_t color,
+                                 size_t limit=SIZE_MAX);
 
     bool set_point(const int x, const int y, const int z, const bool solid, const uint32_t color);
     bool set_point(const size_t pos, const bool solid, const uint32_t color);
 //    void set_column_solid(const size_t x, const size_t y, const size_t z_start, const size_t z_end, const bool solid);
 //    void set_column_color(const size_t x, const size_t y, const size_t z_start, const size_t z_end, const uint32_t color);
     bool check_node(int x, int y, int z, bool destroy=true);
+    // destroys every point, then collapses whatever lost its connection to the ground. returns the collapsed voxels.
+    // with a limit, checks that would visit more than `limit` runs of voxels are deferred to step_collapses instead.
+    // the points that were actually solid go to `destroyed`, if given
+    std::vector<Pos3> destroy_points(const std::vector<Pos3> &points, const size_t limit=0,
+                                     std::vector<Pos3> *destroyed=nullptr);
+    // works through deferred checks, visiting or collapsing at most `limit` runs. returns the voxels collapsed so far
+    std::vector<Pos3> step_collapses(size_t limit);
+    size_t get_pending_collapses() const { return deferred.size() + (job.state != CollapseJob::IDLE); }
+
+    uint64_t get_revision() const { return revision; }
+    std::vector<size_t> get_dirty_chunks(uint64_t since) const;
+
+    void set_journaling(bool enabled);
+    std::vector<JournalItem> get_journal() const;
+    size_t get_journal_size() const { return journal.size(); }
+
+    // bytes allocated for the map, including the scratch space of floating block checks and the spawn and journal
+    // bookkeeping. hash tables are estimated, since their nodes are allocated by the standard library
+    size_t memory_usage() const;
+
+    // everything read() parses out of a vxl, as it's laid out in memory, for read_snapshot to load back with a few
+    // copies. only meant to be read by the same build of the server that wrote it
+    std::vector<uint8_t> write_snapshot() const;
+    // false if `buf` isn't a snapshot of this map format
+    bool read_snapshot(const uint8_t *buf, const size_t size);
+
+    // the geometry masks and the heightmap, indexed by get_column
+    const uint64_t *get_geometry() const { return geometry.data(); }
+    const uint8_t *get_heights() const { return heights.data(); }
 
 private:
-    std::bitset<MAP_X * MAP_Y * MAP_Z> geometry;
-    uint32_t colors[MAP_X * MAP_Y * MAP_Z];
+    // one mask per column, bit z set if the voxel is solid
+    std::vector<uint64_t> geometry;
+    // z of the topmost solid voxel of each column (MAP_Z if there's none), kept up to date by set_height
+    std::vector<uint8_t> heights;
+    ColorStore colors;
 
-    std::vector<Pos3> nodes;
-    std::unordered_set<size_t> marked;
+    bool get_solid(const size_t pos) const {
+        return (this->geometry[pos / MAP_Z] >> (pos % MAP_Z)) & 1;
+    }
+
+    uint32_t get_color(const size_t pos) const {
+        return this->colors.get(pos / MAP_Z, static_cast<int>(pos % MAP_Z));
+    }
+
+    // bit z set if the voxel is solid and next to air
+    uint64_t get_surface(const int x, const int y) const;
+
+    enum Support { FLOATING, GROUNDED, UNKNOWN };
+    struct Node {
+        size_t column;
+        int z;
+    };
+    struct Run {
+        size_t column;
+        uint64_t mask;
+    };
+
+    // scratch space for find_ground, allocated on first use and cleared column by column after each search
+    std::vector<Node> nodes;
+    std::vector<Pos3> seeds;
+    // the voxels found by the last find_ground, as vertical runs
+    std::vector<Run> runs;
+    std::vector<uint64_t> visited;
+    // voxels known to be grounded. nothing ungrounds a voxel except removing another one, so these are kept until the
+    // next voxel is removed (collapses don't count: what they remove wasn't holding anything up)
+    std::vector<uint64_t> grounded;
+    std::vector<size_t> grounded_columns;
+    uint64_t removals = 0;
+
+    // a check that's spread over several step_collapses calls, with its own search state
+    struct CollapseJob {
+        enum { IDLE, SEARCHING, COLLAPSING } state = IDLE;
+        std::vector<Node> nodes;
+        std::vector<Run> runs;
+        std::vector<uint64_t> visited;
+        size_t collapsed = 0;
+        // voxels removed before the search started, so it only marks what it found as grounded if nothing was since
+        uint64_t removals = 0;
+    } job;
+    std::deque<Pos3> deferred;
+
+    Support search(std::vector<Node> &nodes, std::vector<Run> &runs, std::vector<uint64_t> &visited, size_t &budget,
+                   const bool use_grounded);
+    Support find_ground(const int x, const int y, const int z, const bool use_grounded=false, const size_t limit=0);
+    Support find_ground_budget(const int x, const int y, const int z, const bool use_grounded, size_t &budget);
+    void destroy_run(const size_t column, uint64_t mask);
+    void mark_grounded(const std::vector<Run> &runs);
+    void forget_grounded();
+    void end_job();
+
+    bool touches(const std::vector<uint64_t> &mask, const size_t column, const int z) const {
+        const uint64_t bit = uint64_t(1) << z;
+        const size_t cx = column % MAP_X, cy = column / MAP_X;
+        return (mask[column] & ((bit << 1) | (bit >> 1) | bit)) ||
+               (cx     >     0 && (mask[column - 1] & bit)) ||
+               (cx + 1 < MAP_X && (mask[column + 1] & bit)) ||
+               (cy     >     0 && (mask[column - MAP_X] & bit)) ||
+               (cy + 1 < MAP_Y && (mask[column + MAP_X] & bit));
+    }
 
     std::default_random_engine eng;
 
+    // the columns a player can spawn on top of, for every SPAWN_BUCKET x SPAWN_BUCKET area of the map. cells are
+    // stored as x + y * SPAWN_BUCKET within the bucket. a bucket is rebuilt when it's next used after a height in it
+    // changed
+    struct SpawnBucket {
+        std::vector<uint8_t> cells;
+        bool dirty = true;
+    };
+    std::vector<SpawnBucket> spawns;
+    // bumped whenever a bucket goes dirty
+    uint64_t spawn_edits = 0;
+    // the areas spawn points were picked from, with how many cells come before each of the area's buckets (row by
+    // row) and the total at the end, so picking a cell only takes a binary search while the area is unchanged
+    struct SpawnArea {
+        uint64_t edits = 0;
+        std::vector<uint32_t> offsets;
+    };
+    std::unordered_map<uint64_t, SpawnArea> spawn_areas;
+
+    void reset_spawns();
+
+    bool is_spawnable(const size_t column) const {
+        return this->heights[column] < MAP_Z - 2;
+    }
+    SpawnBucket &get_spawn_bucket(const size_t bx, const size_t by);
+    bool get_spawn_point(int *x, int *y, int *z, int x1, int y1, int x2, int y2);
+
+    void set_height(const size_t column, const int top) {
+        if (this->heights[column] == top)
+            return;
+        this->heights[column] = static_cast<uint8_t>(top);
+        const size_t x = column % MAP_X, y = column / MAP_X;
+        SpawnBucket &bucket = this->spawns[x / SPAWN_BUCKET + y / SPAWN_BUCKET * SPAWN_BUCKETS_X];
+        if (!bucket.dirty) {
+            bucket.dirty = true;
+            this->spawn_edits++;
+        }
+    }
+
+    // bumped on every edit so serialized copies of the map know when they're stale
+    uint64_t revision;
+    // revision of the last edit that touched each chunk
+    std::vector<uint64_t> chunk_revisions;
+
+    void mark_dirty(const int x, const int y);
+
+    // net change of every voxel edited since the map was read, if enabled
+    bool journaling;
+    std::unordered_map<size_t, JournalEntry> journal;
+
+    void record(const size_t pos, const bool solid, const uint32_t color);
+
     void add_node(std::vector<Pos3> &v, const int x, const int y, const int z) {
         if (!this->get_solid(x, y, z))
             return;
@@ -39,12 +39,16 @@ cdef class WorldObject:
 
 cdef class Player:
     cdef AcePlayer *ply
+    cdef readonly vxl.VXLMap map
+    # position and orientation the last time check_moved returned True
+    cdef math3d_c.Vector3[double] sent_position, sent_orientation
     cdef public:
         math3d.Vector3 position, velocity, orientation, eye
 
 
 cdef class Grenade:
     cdef AceGrenade *grenade
+    cdef readonly vxl.VXLMap map
     cdef public:
         math3d.Vector3 position, velocity
 
@@ -1,5 +1,50 @@
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+from libc.stdint cimport uint8_t
+
+from acelib import packets
+
+
 cdef extern from "math.h":
     double floor(double x)
+    const double NAN
+
+
+# a player's entry in a world update, as it goes on the wire
+cdef packed struct WorldUpdateEntry:
+    uint8_t player_id
+    float px, py, pz
+    float ox, oy, oz
+
+
+cdef uint8_t WORLD_UPDATE_ID = packets.WorldUpdate.id
+
+
+cdef inline void write_world_update_entry(WorldUpdateEntry *entry, uint8_t player_id, AcePlayer *ply) nogil:
+    entry.player_id = player_id
+    entry.px, entry.py, entry.pz = ply.p.x, ply.p.y, ply.p.z
+    entry.ox, entry.oy, entry.oz = ply.f.x, ply.f.y, ply.f.z
+
+
+def pack_world_update(list players):
+    """
+    A WorldUpdate packet with the current position and orientation of each of `players`, a list of
+    (player id, Player) pairs. Entries are written straight from the native player state into the packet.
+    """
+    cdef:
+        Py_ssize_t index, count = len(players)
+        bytes data = PyBytes_FromStringAndSize(NULL, 1 + count * sizeof(WorldUpdateEntry))
+        char *buf = PyBytes_AS_STRING(data)
+        WorldUpdateEntry *entries = <WorldUpdateEntry *> (buf + 1)
+        tuple pair
+        Player player
+
+    buf[0] = WORLD_UPDATE_ID
+    for index in range(count):
+        pair = <tuple?> players[index]
+        player = <Player?> pair[1]
+        write_world_update_entry(&entries[index], pair[0], player.ply)
+    return data
+
 
 def cast_ray(vxl.VXLMap map, math3d.Vector3 pos, math3d.Vector3 dir, double length=32, bint isdirection=True):
     cdef long x, y, z
@@ -20,10 +65,13 @@ cdef class WorldObject:
 cdef class Player:
     def __cinit__(self, vxl.VXLMap map):
         self.ply = new AcePlayer(map.map_data)
+        self.map = map
         self.position = math3d.new_proxy_vector(&self.ply.p)
         self.velocity = math3d.new_proxy_vector(&self.ply.v)
         self.orientation = math3d.new_proxy_vector(&self.ply.f)
         self.eye = math3d.new_proxy_vector(&self.ply.e)
+        self.sent_position.set(NAN, NAN, NAN)
+        self.sent_orientation.set(NAN, NAN, NAN)
 
     def __init__(self, vxl.VXLMap map):
         pass
@@ -31,6 +79,11 @@ cdef class Player:
     def __dealloc__(self):
         del self.ply
 
+    def set_map(self, vxl.VXLMap map):
+        """Move the player over to `map`, e.g. once the server switched maps."""
+        self.ply.map = map.map_data
+        self.map = map
+
     def set_crouch(self, bint value):
         if value == self.ply.crouch:
             return
@@ -151,10 +204,22 @@ cdef class Player:
     def update(self, double dt, double time):
         return self.ply.update(dt, time)
 
+    def check_moved(self, double threshold):
+        """
+        Whether the player moved, or their orientation changed, by more than `threshold` on any axis since the last
+        time this returned True.
+        """
+        if self.ply.p.equals(self.sent_position, threshold) and self.ply.f.equals(self.sent_orientation, threshold):
+            return False
+        self.sent_position = self.ply.p
+        self.sent_orientation = self.ply.f
+        return True
+
 
 cdef class Grenade:
     def __cinit__(self, vxl.VXLMap map, double px, double py, double pz, double vx, double vy, double vz):
         self.grenade = new AceGrenade(map.map_data, px, py, pz, vx, vy, vz)
+        self.map = map
         self.position = math3d.new_proxy_vector(&self.grenade.p)
         self.velocity = math3d.new_proxy_vector(&self.grenade.v)
 
@@ -164,6 +229,10 @@ cdef class Grenade:
     def __dealloc__(self):
         del self.grenade
 
+    def set_map(self, vxl.VXLMap map):
+        self.grenade.map = map.map_data
+        self.map = map
+
     def update(self, double dt, double time):
         return self.grenade.update(dt, time)
 
@@ -184,5 +253,8 @@ cdef class GenericMovement:
         self.map = map
         self.position = math3d.Vector3(x, y, z)
 
+    def set_map(self, vxl.VXLMap map):
+        self.map = map
+
     def update(self, double dt, double time):
         return clipbox(self.map.map_data, floor(self.position.x), floor(self.position.y), floor(self.position.z))
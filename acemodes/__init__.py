@@ -27,6 +27,7 @@ class GameMode:
         connection.ServerConnection.on_player_kill += self.on_player_kill
 
         self.win_sound = self.protocol.create_sound("horn")
+        self._resetting = False
 
     def start(self):
         pass
@@ -35,16 +36,27 @@ class GameMode:
         pass
 
     async def reset(self, winner: types.Team=None):
-        self.protocol.loop.create_task(self.on_game_end(winner))
-        if winner is not None:
-            self.win_sound.play()
-            self.protocol.broadcast_hud_message(f"{winner.name} team wins!")
-        self.stop()
-        self.start()
-        for player in self.protocol.players.values():
-            player.spawn()
-        for team in self.protocol.teams.values():
-            team.reset()
+        # switching maps takes a while, and a second reset meanwhile would start the mode twice
+        if self._resetting:
+            return
+        self._resetting = True
+        try:
+            self.protocol.loop.create_task(self.on_game_end(winner))
+            if winner is not None:
+                self.win_sound.play()
+                self.protocol.broadcast_hud_message(f"{winner.name} team wins!")
+            self.stop()
+            for team in self.protocol.teams.values():
+                if not team.spectator:
+                    team.reset()
+            # with a new map, players respawn once they've downloaded it
+            switched = await self.protocol.rotate_map()
+            self.start()
+            if not switched:
+                for player in self.protocol.players.values():
+                    player.spawn()
+        finally:
+            self._resetting = False
 
     def check_win(self):
         if any(team.score == self.score_limit for team in self.protocol.teams.values()):
@@ -74,6 +74,16 @@ class EssentialsScript(Script):
             obj.fuse = eta
         obj.broadcast_item()
 
+    @commands.command(admin=True)
+    def joinqueue(self, connection: ServerConnection):
+        queue = self.protocol.join_queue
+        connection.send_server_message(f"{len(queue.active)} downloading, {queue.depth} queued, "
+                                       f"average wait {queue.average_wait:.1f}s")
+
+    @commands.command(admin=True)
+    def nextmap(self, connection: ServerConnection):
+        self.protocol.loop.create_task(self.protocol.mode.reset())
+
     @commands.command(admin=True)
     def fog(self, connection: ServerConnection, r: int, g: int, b: int):
         self.protocol.set_fog_color(r, g, b)
@@ -0,0 +1,175 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import hashlib
+import os
+import struct
+from typing import *
+
+from acelib import vxl
+from aceserver import protocol
+
+__all__ = ["MapSaver", "read_map"]
+
+DIFF_MAGIC = b"ACEDIFF1"
+# magic, sha1 of the vxl file the diff applies to
+DIFF_HEADER = struct.Struct("<8s20s")
+# index and size of a map chunk, followed by the chunk. later records replace earlier ones for the same chunk
+DIFF_RECORD = struct.Struct("<II")
+# once a diff has replaced this many distinct chunks, the next checkpoint saves the whole map again instead
+COMPACT_CHUNKS = vxl.VXL_MAP_CHUNKS // 4
+# past this many edited chunks, copying the map and serializing them from the copy in a worker stalls the loop less
+COPY_CHUNKS = 256
+
+
+def read_map(path: str) -> bytes:
+    """The vxl file at `path`, with the edits from its autosave diff applied if it has one."""
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        with open(path + ".diff", "rb") as f:
+            diff = f.read()
+    except FileNotFoundError:
+        return data
+    if len(diff) <= DIFF_HEADER.size:
+        return data
+    magic, digest = DIFF_HEADER.unpack_from(diff)
+    # a diff left over from before the map was saved in full again doesn't apply to it
+    if magic != DIFF_MAGIC or digest != hashlib.sha1(data).digest():
+        return data
+
+    chunks = vxl.VXLMap(data).get_chunks()
+    offset = DIFF_HEADER.size
+    while offset + DIFF_RECORD.size <= len(diff):
+        index, size = DIFF_RECORD.unpack_from(diff, offset)
+        offset += DIFF_RECORD.size
+        if index >= len(chunks) or offset + size > len(diff):
+            break  # the server stopped partway through a checkpoint
+        chunks[index] = diff[offset:offset + size]
+        offset += size
+    return b''.join(chunks)
+
+
+class MapSaver:
+    """
+    Saves the map set with `set_map` to `directory` every `interval` seconds while it's being edited, and once more when
+    the server shuts down or switches maps.
+
+    A map's first checkpoint writes all of it, from a copy. After that, checkpoints only append the map chunks edited
+    since the previous one to a sidecar diff next to it, which `read_map` applies when the map is read back. Once the
+    diff holds a quarter of the map, the next checkpoint writes the whole map again and starts a new diff.
+
+    Each checkpoint captures the map exactly as it was at the end of a tick: a few edited chunks are serialized right
+    away on the event loop, otherwise the map is copied and serialized on the protocol's executor. Files are always
+    written on the executor, one checkpoint after the other.
+    """
+    def __init__(self, protocol: 'protocol.ServerProtocol', directory: str, interval: float=300):
+        self.protocol = protocol
+        self.directory = directory
+        self.interval = interval
+
+        self.map: vxl.VXLMap = None
+        # map revision the last checkpoint saved
+        self.revision: int = None
+        # chunks replaced by the diff so far, None until the map was first saved in full
+        self.diff_chunks: Optional[Set[int]] = None
+
+        self._pending: concurrent.futures.Future = None
+        # a save didn't make it to disk, so the diff can't be appended to until the whole map is written again
+        self._failed = False
+
+    def set_map(self, map: vxl.VXLMap):
+        """Save `map` from now on. It's written in full once it's first edited."""
+        self.map = map
+        self.revision = map.revision
+        self.diff_chunks = None
+
+    def path(self, map: vxl.VXLMap) -> str:
+        return os.path.join(self.directory, os.path.basename(map.name) + ".vxl")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            save = self.checkpoint()
+            if save is not None:
+                await asyncio.wrap_future(save)
+
+    def checkpoint(self) -> Optional[concurrent.futures.Future]:
+        """Start saving the edits made to the map since the last checkpoint. Returns the save, if there is one."""
+        job = self._prepare()
+        if job is None:
+            return None
+        previous = self._pending
+        self._pending = self.protocol.executor.submit(self._run, previous, *job)
+        return self._pending
+
+    def save(self):
+        """Checkpoint and wait for every save to finish, e.g. while shutting down."""
+        job = self._prepare()
+        if self._pending is not None:
+            concurrent.futures.wait((self._pending,))
+        if job is not None:
+            self._run(None, *job)
+
+    def _prepare(self) -> Optional[tuple]:
+        map = self.map
+        if map is None:
+            return None
+        dirty = map.get_dirty_chunks(self.revision)
+        # after a failed save the edits it had are only on disk once the whole map is written again
+        if not dirty and not self._failed:
+            return None
+        self.revision = map.revision
+
+        if self.diff_chunks is None or self._failed or len(self.diff_chunks.union(dirty)) > COMPACT_CHUNKS:
+            self.diff_chunks = set()
+            self._failed = False
+            return self.write_map, self.path(map), map.copy()
+        self.diff_chunks.update(dirty)
+        if len(dirty) > COPY_CHUNKS:
+            snapshot = map.copy()
+            chunks = ((index, snapshot.get_chunk(index)) for index in dirty)
+        else:
+            chunks = [(index, map.get_chunk(index)) for index in dirty]
+        return self.write_diff, self.path(map), chunks
+
+    def _run(self, previous: Optional[concurrent.futures.Future], write: Callable, path: str, data):
+        # checkpoints only make sense applied in order
+        if previous is not None:
+            concurrent.futures.wait((previous,))
+        # the edits in this diff are in the full save the next checkpoint does instead
+        if self._failed and write == self.write_diff:
+            return
+        try:
+            write(path, data)
+        except OSError as e:
+            print(f"Could not save map {path}: {e}")
+            self._failed = True
+
+    @staticmethod
+    def write_map(path: str, map: vxl.VXLMap):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        digest = hashlib.sha1()
+        with open(path + ".tmp", "wb") as f:
+            for index in range(vxl.VXL_MAP_CHUNKS):
+                chunk = map.get_chunk(index)
+                digest.update(chunk)
+                f.write(chunk)
+        os.replace(path + ".tmp", path)
+        with open(path + ".diff", "wb") as f:
+            f.write(DIFF_HEADER.pack(DIFF_MAGIC, digest.digest()))
+
+    @staticmethod
+    def write_diff(path: str, chunks: Iterable[Tuple[int, bytes]]):
+        with open(path + ".diff", "ab") as f:
+            size = f.tell()
+            try:
+                for index, chunk in chunks:
+                    f.write(DIFF_RECORD.pack(index, len(chunk)))
+                    f.write(chunk)
+                f.flush()
+            except OSError:
+                # don't leave half a record for the next checkpoint to append after
+                with contextlib.suppress(OSError):
+                    f.truncate(size)
+                raise
@@ -4,8 +4,18 @@ import typing
 
 import enet
 
+from acelib.constants import UPDATE_FPS
 from aceserver import util
 
+# ticks run back to back to catch up after a stall. any further behind than that and the rest are skipped
+MAX_CATCH_UP_TICKS = 5
+# skipped ticks are reported at most this often, in seconds
+OVERRUN_REPORT_INTERVAL = 5
+# updates sent to clients per second. the server used to send one after every tick, at about 30 a second
+DEFAULT_NETWORK_RATE = 30.0
+# most enet events handled each time the socket becomes readable, so a flood of packets can't hold up the tick
+NET_EVENT_BUDGET = 64
+
 
 class BaseConnection:
     def on_connect(self, data):
@@ -20,7 +30,8 @@ class BaseConnection:
 
 class BaseProtocol:
     def __init__(self, loop: asyncio.AbstractEventLoop, interface: str="", port: int=32887, max_connections: int=32,
-                 connection_factory=BaseConnection):
+                 connection_factory=BaseConnection, tick_rate: float=UPDATE_FPS,
+                 network_rate: float=DEFAULT_NETWORK_RATE, flush_every_tick: bool=True):
         self.loop: asyncio.AbstractEventLoop = loop
         self.host: enet.Host = enet.Host(enet.Address(interface, port), max_connections, 1, 0, 0)
         self.host.compress_with_range_coder()
@@ -29,30 +40,76 @@ class BaseProtocol:
 
         self.connections: typing.Dict[enet.Peer, BaseConnection] = {}
 
+        # simulation steps per second, and how many of those are followed by sending updates to clients
+        self.tick_rate = tick_rate
+        self.network_rate = network_rate
+        # send what each tick queued right away, rather than with the next service() call
+        self.flush_every_tick = flush_every_tick
         self.time = 0
         self.running = True
+        # ticks that took longer than a step to run, and ticks skipped because the server fell too far behind
+        self.overruns = 0
+        self.skipped_ticks = 0
 
     async def run(self):
         ip, port = util.get_ip(), self.host.address.port
         print(f"Running server on {ip}:{port}")
         print(f"Server identifier is {util.get_identifier(ip, port)}")
 
-        last: float = self.loop.time()
+        try:
+            self.loop.add_reader(self.host.socket.fileno(), self.net_readable)
+        except NotImplementedError:
+            pass  # e.g. the proactor loop on windows, packets are only handled once per tick then
+
+        # every tick simulates exactly one step, and is scheduled against the clock rather than after the last one, so
+        # the tick rate doesn't drift with how long ticks take
+        loop = self.loop
+        step = 1 / self.tick_rate
+        network_step = 1 / self.network_rate
+        next_tick = next_network = loop.time()
+        reported, last_report = 0, next_tick - OVERRUN_REPORT_INTERVAL
         while self.running:
-            now = self.loop.time()
-            dt = now - last
-            self.time += dt
-            try:
-                self.update(dt)
-            except Exception:
-                print("Ignoring exception in update(): ")
-                traceback.print_exc()
-            await asyncio.sleep(1 / 30)
-            # print(self.time, dt, 1 / dt)
-            last = now
+            now = loop.time()
+            ticks = 0
+            while next_tick <= now and ticks < MAX_CATCH_UP_TICKS:
+                started = loop.time()
+                self.time += step
+                try:
+                    self.update(step)
+                except Exception:
+                    print("Ignoring exception in update(): ")
+                    traceback.print_exc()
+                if loop.time() - started > step:
+                    self.overruns += 1
+                next_tick += step
+                ticks += 1
+            if next_tick <= now:
+                skipped = int((now - next_tick) / step) + 1
+                self.skipped_ticks += skipped
+                next_tick += skipped * step
+                if now - last_report >= OVERRUN_REPORT_INTERVAL:
+                    skipped = self.skipped_ticks - reported
+                    print(f"Can't keep up! Skipped {skipped} ticks ({skipped * step:.2f}s)")
+                    reported, last_report = self.skipped_ticks, now
+
+            if next_network <= now:
+                try:
+                    self.send_updates()
+                except Exception:
+                    print("Ignoring exception in send_updates(): ")
+                    traceback.print_exc()
+                # late updates aren't made up for, the next one has the latest state anyway
+                next_network = max(next_network + network_step, now)
+            if self.flush_every_tick:
+                self.host.flush()
+            await asyncio.sleep(min(next_tick, next_network) - loop.time())
 
     def stop(self):
         self.running = False
+        try:
+            self.loop.remove_reader(self.host.socket.fileno())
+        except NotImplementedError:
+            pass
         print("Shutting down...")
         for peer in self.connections.keys():
             peer.disconnect()
@@ -63,15 +120,21 @@ class BaseProtocol:
     def update(self, dt):
         self.net_update()
 
-    def net_update(self):
-        while True:
+    def send_updates(self):
+        pass
+
+    def net_update(self, budget: int=None) -> bool:
+        # handles at most `budget` events, returns whether there may be more
+        handled = 0
+        while budget is None or handled < budget:
+            handled += 1
             try:
                 if self.host is None:
-                    return
+                    return False
                 event = self.host.service(0)
                 event_type = event.type
                 if not event or event_type == enet.EVENT_TYPE_NONE:
-                    return
+                    return False
 
                 peer = event.peer
                 if event_type == enet.EVENT_TYPE_CONNECT:
@@ -83,6 +146,13 @@ class BaseProtocol:
             except:
                 print("Ignoring exception in net_loop(): ")
                 traceback.print_exc()
+        return True
+
+    def net_readable(self):
+        # the socket got datagrams between ticks, so handle them right away instead of at the next tick. anything
+        # queued in reply goes out with the last service() call, the one that finds no more events
+        if self.net_update(NET_EVENT_BUDGET):
+            self.loop.call_soon(self.net_readable)
 
     def connect(self, connection_factory: typing.Type[BaseConnection], addr: enet.Address, channels: int, data: int):
         peer = self.host.connect(addr, channels, data)
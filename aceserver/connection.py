@@ -1,9 +1,7 @@
 import asyncio
-import io
 import sys
 import textwrap
 import traceback
-import zlib
 from collections import defaultdict
 from typing import *
 
@@ -12,7 +10,7 @@ import enet
 from acelib import packets, math3d, world
 from acelib.bytes import ByteReader, ByteWriter
 from acelib.constants import *
-from aceserver import base, protocol, types, weapons, util
+from aceserver import base, protocol, types, weapons, util, transfer
 from aceserver.loaders import *
 
 
@@ -49,6 +47,12 @@ class ServerConnection(base.BaseConnection):
         self.store = {}
 
         self._listeners: Dict[int, List[asyncio.Future]] = defaultdict(list)
+        self._pack_responses: asyncio.Queue = None
+        self._connecting: asyncio.Task = None
+        self._map_reload: asyncio.Task = None
+        # the last InputData and WeaponInput forwarded for this player, for clients it comes within range of
+        self.input_state: bytes = None
+        self.weapon_input_state: bytes = None
 
     def on_connect(self, data: int):
         if data != PROTOCOL_VERSION:
@@ -59,9 +63,15 @@ class ServerConnection(base.BaseConnection):
         except KeyError:
             return self.disconnect(DISCONNECT.FULL)
 
-        self.protocol.loop.create_task(self.send_connection_data())
+        self._connecting = self.protocol.loop.create_task(self.send_connection_data())
 
     def on_disconnect(self):
+        self.protocol.join_queue.cancel(self)
+        # frees this connection's download slot right away, rather than once its transfer notices
+        if self._connecting is not None:
+            self._connecting.cancel()
+        if self._map_reload is not None:
+            self._map_reload.cancel()
         if self.id is not None:
             self.protocol.loop.create_task(self.on_player_leave(self))
 
@@ -76,7 +86,7 @@ class ServerConnection(base.BaseConnection):
             return self.disconnect()
         self.received_loader(loader)
 
-    def _send_loader(self, writer: ByteWriter, flags=enet.PACKET_FLAG_RELIABLE):
+    def _send_loader(self, writer: Union[ByteWriter, bytes], flags=enet.PACKET_FLAG_RELIABLE):
         packet: enet.Packet = enet.Packet(bytes(writer), flags)
         self.peer.send(0, packet)
 
@@ -118,8 +128,14 @@ class ServerConnection(base.BaseConnection):
 
     async def send_connection_data(self):
         self.send_info()
-        await self.send_packs()
-        await self.send_map()
+        try:
+            async with self.protocol.join_queue.admit(self):
+                await self.send_packs()
+                await self.send_map()
+        except ConnectionError:
+            return
+        self._connecting = None
+        self.send_map_journal()
         self.send_state()
         self.send_players()
         await self.on_player_connect(self)
@@ -130,39 +146,81 @@ class ServerConnection(base.BaseConnection):
         self.send_loader(initial_info)
 
     async def send_packs(self):
-        for data, length, crc32 in self.protocol.packs:
-            pack_start.checksum = crc32
-            pack_start.size = length
-            self.send_loader(pack_start)
+        packs = self.protocol.packs
+        if not packs:
+            return
 
-            try:
-                has_pack: bool = (await self.wait_for(packets.PackResponse, 3)).value
-            except asyncio.TimeoutError:
-                continue
-            if has_pack:  # client has pack cached
-                continue
+        # offer every pack at once, the responses come back in the same order
+        self._pack_responses = responses = asyncio.Queue()
+        for pack in packs:
+            pack_start.checksum = pack.checksum
+            pack_start.size = pack.size
+            self.send_loader(pack_start)
 
-            with io.BytesIO(data) as f:
-                while True:
-                    data = f.read(1024)
-                    if not data:
-                        break
-                    pack_chunk.data = data
-                    self.send_loader(pack_chunk)
-                    await asyncio.sleep(0.1)
+        missing: List[transfer.Pack] = []
+        deadline = self.protocol.loop.time() + 3
+        try:
+            for pack in packs:
+                has_pack: bool = await asyncio.wait_for(responses.get(), deadline - self.protocol.loop.time())
+                if not has_pack:  # client doesn't have the pack cached
+                    missing.append(pack)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._pack_responses = None
+
+        async with self.protocol.transfers.open(self) as download:
+            for pack in missing:
+                # the client only tracks one incoming pack at a time, so announce it again right before its data
+                pack_start.checksum = pack.checksum
+                pack_start.size = pack.size
+                await download.send(bytes(pack_start.generate()))
+                offset = 0
+                while offset < pack.size:
+                    size = download.chunk_size
+                    await download.send(pack.chunk(offset, size))
+                    offset += size
 
     async def send_map(self):
-        map = self.protocol.map
-        map_start.size = map.estimated_size
-        self.send_loader(map_start)
+        # if the map is switched during the download, the new one is sent right after
+        map_cache = None
+        while map_cache is not self.protocol.map_cache:
+            map_cache = self.protocol.map_cache
+            size, chunks = await map_cache.get()
+            map_start.size = size
+            self.send_loader(map_start)
+
+            async with self.protocol.transfers.open(self) as transfer:
+                for chunk in chunks:
+                    await transfer.send(chunk)
+
+    def reload_map(self):
+        """Send the map again after the server switched maps, and respawn on it if already playing."""
+        if self.id is None or self._connecting is not None:
+            return  # still downloading the first time, which moves on to the new map by itself
+        if self._map_reload is not None and not self._map_reload.done():
+            return  # same for a download that's already running
+        if self.wo is not None:
+            self.wo.set_dead(True)
+        self._map_reload = self.protocol.loop.create_task(self._reload_map())
+
+    async def _reload_map(self):
+        try:
+            # everyone downloads again at once when the map switches, so this waits its turn like joining does
+            async with self.protocol.join_queue.admit(self):
+                await self.send_map()
+        except ConnectionError:
+            return
+        self.send_map_journal()
+        self.send_state()
+        self.send_players()
+        # clients still at team select spawn once they pick one, which may have happened during the download
+        if self.protocol.players.get(self.id) is self and self.dead:
+            self.spawn()
 
-        compressor = zlib.compressobj(9)
-        for chunk in map.iter_compressed(compressor):
-            if len(chunk) <= 0:
-                continue
-            map_chunk.data = chunk
-            self.send_loader(map_chunk)
-            await asyncio.sleep(0.1)
+    def send_map_journal(self):
+        for packet in self.protocol.map_cache.get_journal():
+            self._send_loader(packet)
 
     def send_state(self):
         data = self.protocol.get_state()
@@ -196,6 +254,7 @@ class ServerConnection(base.BaseConnection):
 
         self.wo.set_dead(False)
         self.wo.set_position(*pos, reset=True)
+        self.input_state = self.weapon_input_state = None
         self.restock()
         self.protocol.loop.create_task(self.on_player_spawn(self, x, y, z))
 
@@ -313,14 +372,18 @@ class ServerConnection(base.BaseConnection):
                 return False
             self.block.destroy()
 
-        for ax, ay, az in to_destroy:
-            self.protocol.map.destroy_point(ax, ay, az)
-
-        block_action.player_id = self.id
-        block_action.xyz = (x, y, z)
-        block_action.value = destroy_type
-        self.protocol.broadcast_loader(block_action)
+        destroyed = []
+        collapsed = self.protocol.map.destroy_points(to_destroy, self.protocol.collapse_budget, destroyed)
+        if self.protocol.batch_block_changes:
+            self.protocol.queue_block_changes(destroyed)
+        else:
+            block_action.player_id = self.id
+            block_action.xyz = (x, y, z)
+            block_action.value = destroy_type
+            self.protocol.broadcast_loader(block_action)
         self.protocol.loop.create_task(self.on_destroy_block(self, x, y, z, destroy_type))
+        if collapsed:
+            self.protocol.loop.create_task(self.on_blocks_collapse(self, collapsed))
         return True
 
     def build_block(self, x: int, y: int, z: int) -> bool:
@@ -334,10 +397,13 @@ class ServerConnection(base.BaseConnection):
             x, y, z = hook
 
         if self.protocol.map.build_point(x, y, z, self.block.color.rgb):
-            block_action.player_id = self.id
-            block_action.xyz = (x, y, z)
-            block_action.value = ACTION.BUILD
-            self.protocol.broadcast_loader(block_action)
+            if self.protocol.batch_block_changes:
+                self.protocol.queue_block_changes(((x, y, z),), self.block.color.rgb)
+            else:
+                block_action.player_id = self.id
+                block_action.xyz = (x, y, z)
+                block_action.value = ACTION.BUILD
+                self.protocol.broadcast_loader(block_action)
             self.protocol.loop.create_task(self.on_build_block(self, x, y, z))
             return True
         return False
@@ -346,17 +412,15 @@ class ServerConnection(base.BaseConnection):
         if not self.block.check_rapid(primary=False):
             return False
 
-        points = self.protocol.map.block_line(x1, y1, z1, x2, y2, z2)
+        points = self.protocol.map.build_line(x1, y1, z1, x2, y2, z2, self.block.color.rgb, self.block.primary_ammo)
         if not points:
             return False
-
         if not self.block.build(len(points)):
+            # the limit above should have stopped this, but never hand out blocks the player doesn't have
+            for x, y, z in points:
+                self.protocol.map.set_point(x, y, z, False)
             return False
 
-        for point in points:
-            x, y, z = point
-            self.protocol.map.build_point(x, y, z, self.block.color.rgb)
-
         # TODO hooks
         # hook = await self.try_build_block(self, x, y, z)
         # if hook is False:
@@ -364,10 +428,14 @@ class ServerConnection(base.BaseConnection):
         # if hook is not None:
         #     x, y, z = hook
 
-        block_line.player_id = self.id
-        block_line.xyz1 = x1, y1, z1
-        block_line.xyz2 = x2, y2, z2
-        self.protocol.broadcast_loader(block_line)
+        if self.protocol.batch_block_changes:
+            # sent with the rest of the tick's changes so nobody sees them in a different order than the server made them
+            self.protocol.queue_block_changes(points, self.block.color.rgb)
+        else:
+            block_line.player_id = self.id
+            block_line.xyz1 = x1, y1, z1
+            block_line.xyz2 = x2, y2, z2
+            self.protocol.broadcast_loader(block_line)
         return True
 
     def set_position(self, x=None, y=None, z=None, reset=True):
@@ -410,6 +478,12 @@ class ServerConnection(base.BaseConnection):
     def send_hud_message(self, message: str):
         return self.send_message(message, chat_type=CHAT.BIG)
 
+    @on_loader_receive(packets.PackResponse)
+    def recv_pack_response(self, loader: packets.PackResponse):
+        # responses to the re-announcements before each pack's data arrive after negotiation and are dropped
+        if self._pack_responses is not None:
+            self._pack_responses.put_nowait(loader.value)
+
     @on_loader_receive(packets.PositionOrientationData)
     def recv_client_update(self, loader: packets.PositionOrientationData):
         if self.dead: return
@@ -439,7 +513,8 @@ class ServerConnection(base.BaseConnection):
         self.protocol.loop.create_task(self.on_animation_change(self, *animation))
 
         loader.player_id = self.id
-        self.protocol.broadcast_loader(loader, predicate=lambda conn: conn is not self)
+        self.input_state = bytes(loader.generate())
+        self.protocol.interest.send_to_watchers(self, self.input_state)
 
     @on_loader_receive(packets.ExistingPlayer)
     def recv_existing_player(self, loader: packets.ExistingPlayer):
@@ -506,7 +581,8 @@ class ServerConnection(base.BaseConnection):
         loader.secondary = self.tool.set_secondary(loader.secondary)
         loader.player_id = self.id
         self.wo.set_fire(loader.primary, loader.secondary)
-        self.protocol.broadcast_loader(loader, predicate=lambda conn: conn is not self)
+        self.weapon_input_state = bytes(loader.generate())
+        self.protocol.interest.send_to_watchers(self, self.weapon_input_state)
 
     @on_loader_receive(packets.WeaponReload)
     def recv_weapon_reload(self, loader: packets.WeaponReload):
@@ -727,6 +803,10 @@ class ServerConnection(base.BaseConnection):
     try_destroy_block = util.Event(overridable=True)
     # (self, x, y, z, destroy_type) -> None
     on_destroy_block = util.AsyncEvent()
+    # Called after blocks fall because nothing held them up anymore. `self` is None when it wasn't right after a
+    # destroy, i.e. a big structure that took a few ticks to check
+    # (self, [(x, y, z), ...]) -> None
+    on_blocks_collapse = util.AsyncEvent()
 
     # Called before/after the player sends a chat message
     # (self, chat_message, chat_type) -> None | New `chat_message` to override | False to cancel
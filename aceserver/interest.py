@@ -0,0 +1,155 @@
+from collections import defaultdict
+from typing import *
+
+import enet
+
+from acelib import world
+from aceserver import protocol, connection
+
+__all__ = ["InterestManager"]
+
+
+class InterestManager:
+    """
+    Decides which players each client hears about, and how often.
+
+    Players within `distance` (horizontally) of a client are in its world updates every time, and it's sent their
+    input as it happens. Everyone further away is only in every `far_interval`-th world update, staggered by player
+    id, and their input isn't forwarded; a player's latest input is sent again once they come within range. Clients
+    that aren't alive in the world (spectators, dead players, anyone still joining) hear about everyone.
+
+    Players are bucketed into a grid of `distance`-sized cells, so finding who's near a client only checks the cells
+    around it.
+
+    Players are only sent when they moved or turned by more than `threshold` since they were last sent, so idle players
+    cost nothing. In case the update they last moved in was lost, everyone is sent anyway every `keyframe_interval`
+    updates (rounded up to a multiple of `far_interval`), staggered by player id. A client is always sent the players
+    that just came within its range.
+    """
+    def __init__(self, protocol: 'protocol.ServerProtocol', distance: float, far_interval: int=4,
+                 threshold: float=0.01, keyframe_interval: int=20):
+        self.protocol = protocol
+        self.distance = distance
+        self.far_interval = max(1, far_interval)
+        self.threshold = threshold
+        self.keyframe_interval = -(-max(1, keyframe_interval) // self.far_interval) * self.far_interval
+        self.updates = 0
+
+        # players that moved since they were last in the far players' updates
+        self.far_moved: Set[int] = set()
+
+        # player id -> clients that were last sent that player at full rate
+        self.watchers: Dict[int, Set['connection.ServerConnection']] = {}
+        # client -> ids of the players it was last sent at full rate. clients that aren't in here get everything
+        self.near: Dict['connection.ServerConnection', Set[int]] = {}
+
+    def send_world_update(self):
+        self.updates += 1
+        updates = self.updates
+        distance = self.distance
+
+        players: Dict[int, Tuple[int, world.Player]] = {}
+        # players that moved, or are due a keyframe
+        sent: List[int] = []
+        positions: Dict[int, Tuple[float, float]] = {}
+        grid: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+        for conn in self.protocol.players.values():
+            if not conn.name or conn.dead:
+                continue
+            wo = conn.wo
+            players[conn.id] = (conn.id, wo)
+            if wo.check_moved(self.threshold):
+                self.far_moved.add(conn.id)
+                sent.append(conn.id)
+            elif (updates + conn.id) % self.keyframe_interval == 0:
+                sent.append(conn.id)
+            x, y, _ = wo.position.xyz
+            positions[conn.id] = (x, y)
+            grid[(int(x // distance), int(y // distance))].append(conn.id)
+        self.far_moved.intersection_update(players)
+        everything = None
+        if sent:
+            data = world.pack_world_update([players[player_id] for player_id in sent])
+            everything = enet.Packet(data, enet.PACKET_FLAG_UNSEQUENCED)
+        sent = set(sent)
+
+        far = []
+        for player_id in players:
+            if (updates + player_id) % self.far_interval != 0:
+                continue
+            if player_id in self.far_moved or player_id in sent:
+                far.append(player_id)
+            self.far_moved.discard(player_id)
+
+        near_players = self._find_near(positions, grid)
+        watchers: Dict[int, Set['connection.ServerConnection']] = defaultdict(set)
+        near_sets: Dict['connection.ServerConnection', Set[int]] = {}
+        for conn in self.protocol.connections.values():
+            near = near_players.get(conn.id) if self.protocol.players.get(conn.id) is conn else None
+            if near is None:
+                if everything is not None:
+                    conn.peer.send(0, everything)
+                continue
+
+            near_sets[conn] = near
+            for player_id in near:
+                watchers[player_id].add(conn)
+            entered = near - self.near.get(conn, set())
+            self._catch_up(conn, entered)
+
+            ids = entered.union(
+                [player_id for player_id in near if player_id in sent],
+                [player_id for player_id in far if player_id != conn.id]
+            )
+            if ids:
+                data = world.pack_world_update([players[player_id] for player_id in ids])
+                conn.peer.send(0, enet.Packet(data, enet.PACKET_FLAG_UNSEQUENCED))
+
+        self.watchers = watchers
+        self.near = near_sets
+
+    def _find_near(self, positions: Dict[int, Tuple[float, float]],
+                   grid: Dict[Tuple[int, int], List[int]]) -> Dict[int, Set[int]]:
+        # being near is symmetric, so each pair of players is only checked once: every cell against itself and the
+        # neighbours that come after it
+        sq_distance = self.distance * self.distance
+        near: Dict[int, Set[int]] = {player_id: set() for player_id in positions}
+        for (cx, cy), cell in grid.items():
+            for index, player_id in enumerate(cell):
+                x, y = positions[player_id]
+                for other_id in cell[index + 1:]:
+                    px, py = positions[other_id]
+                    if (px - x) ** 2 + (py - y) ** 2 <= sq_distance:
+                        near[player_id].add(other_id)
+                        near[other_id].add(player_id)
+            for other_cell in (grid.get((cx + 1, cy - 1)), grid.get((cx + 1, cy)), grid.get((cx + 1, cy + 1)),
+                               grid.get((cx, cy + 1))):
+                if not other_cell:
+                    continue
+                for player_id in cell:
+                    x, y = positions[player_id]
+                    for other_id in other_cell:
+                        px, py = positions[other_id]
+                        if (px - x) ** 2 + (py - y) ** 2 <= sq_distance:
+                            near[player_id].add(other_id)
+                            near[other_id].add(player_id)
+        return near
+
+    def _catch_up(self, conn: 'connection.ServerConnection', player_ids: Set[int]):
+        # input from players that just came within range was never forwarded, so send where it's at now
+        for player_id in player_ids:
+            player = self.protocol.players.get(player_id)
+            if player is None:
+                continue
+            for data in (player.input_state, player.weapon_input_state):
+                if data is not None:
+                    conn.peer.send(0, enet.Packet(data, enet.PACKET_FLAG_RELIABLE))
+
+    def send_to_watchers(self, conn: 'connection.ServerConnection', data: bytes):
+        """Send `data` about `conn` to every other client that sees it at full rate."""
+        packet = enet.Packet(data, enet.PACKET_FLAG_RELIABLE)
+        watchers = self.watchers.get(conn.id, ())
+        for other in self.protocol.connections.values():
+            if other is conn or (other in self.near and other not in watchers):
+                continue
+            other.peer.send(0, packet)
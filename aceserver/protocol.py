@@ -1,8 +1,7 @@
 import asyncio
 import json
 import textwrap
-import os
-import zlib
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from typing import *
 
@@ -13,27 +12,54 @@ import acemodes
 from acelib import packets, vxl, world
 from acelib.bytes import ByteWriter
 from acelib.constants import *
-from aceserver import base, util, connection, types
+from aceserver import base, util, connection, types, transfer, autosave, interest
 from aceserver.loaders import *
 
 
 class ServerProtocol(base.BaseProtocol):
     def __init__(self, config, *, loop):
         super().__init__(loop=loop, interface=config["interface"], port=config["port"],
-                         connection_factory=connection.ServerConnection)
+                         connection_factory=connection.ServerConnection, tick_rate=config.get("tick_rate", UPDATE_FPS),
+                         network_rate=config.get("network_rate", base.DEFAULT_NETWORK_RATE),
+                         flush_every_tick=config.get("flush_every_tick", True))
 
         self.config = config
         self.name = self.config["name"]
         self.max_players = min(32, self.config.get("max_players", 32))
 
-        with open(self.config["map"], "rb") as f:
-            self.map: vxl.VXLMap = vxl.VXLMap(f.read(), {"name": os.path.splitext(f.name)[0]})
-
-        self.packs: List[Tuple[bytes, int, int]] = []
-        for pname in self.config.get("packs", ()):
-            with open(pname, "rb") as f:
-                data = f.read()
-                self.packs.append((data, len(data), zlib.crc32(data)))
+        # for anything heavy enough to stall the tick (map serialization, compression, ...)
+        self.executor = ThreadPoolExecutor(self.config.get("worker_threads"), thread_name_prefix="ace")
+
+        self.map_cache = self.create_map_cache()
+        # bytes per second shared by all map and pack downloads, 0 for no limit
+        self.transfers = transfer.TransferScheduler(self, self.config.get("transfer_rate", transfer.DEFAULT_TRANSFER_RATE))
+        # how many clients may download packs and the map at once, 0 for no limit
+        self.join_queue = transfer.JoinQueue(self, self.config.get("max_downloads", 4))
+        self.map: vxl.VXLMap = self.map_cache.open(self.config["map"])
+        # maps played in turn, switching at the end of each round. the next one is loaded and compressed in the
+        # background while the current one is played
+        self.map_rotation: List[str] = self.config.get("map_rotation") or [self.config["map"]]
+        self.map_index = self.map_rotation.index(self.config["map"]) if self.config["map"] in self.map_rotation else -1
+        self.next_map: Optional[asyncio.Task] = None
+        # edits to the map are saved in this directory every "autosave_interval" seconds and on shutdown.
+        # None to disable
+        self.map_saver: Optional[autosave.MapSaver] = None
+        if self.config.get("map_autosave"):
+            self.map_saver = autosave.MapSaver(self, self.config["map_autosave"],
+                                               self.config.get("autosave_interval", 300))
+            self.map_saver.set_map(self.map)
+
+        self.packs: List[transfer.Pack] = [transfer.Pack(path) for path in self.config.get("packs", ())]
+        # zlib releases the GIL while checksumming, so large packs are hashed in parallel
+        list(self.executor.map(transfer.Pack.compute_checksum, self.packs))
+
+        # most runs of voxels a floating block check may visit per tick; bigger ones carry over to the next ticks
+        self.collapse_budget = self.config.get("collapse_budget", 4096)
+        # send the map changes made during a tick together at the end of it, as server block actions. their items
+        # carry 16-bit x and y, so only enable this for clients that read them that way
+        self.batch_block_changes = self.config.get("batch_block_changes", False)
+        # (x, y, z) -> [whether the block was there before the tick, its color now or None if it's gone]
+        self.block_changes: Dict[Tuple[int, int, int], list] = {}
 
         self.player_ids = util.IDPool(stop=self.max_players)
         self.entity_ids = util.IDPool(stop=255)
@@ -49,6 +75,12 @@ class ServerProtocol(base.BaseProtocol):
         self.teams = {self.team1.id: self.team1, self.team2.id: self.team2, self.spectator_team.id: self.spectator_team}
 
         self.fog_color = self.config.get("fog_color", (128, 232, 255))
+        # players further away than this are only sent every "interest_far_interval"-th world update, and players are
+        # only sent when they moved by more than "world_update_threshold" or are due a keyframe
+        self.interest = interest.InterestManager(self, self.config.get("interest_distance", FOG_DISTANCE),
+                                                 self.config.get("interest_far_interval", 4),
+                                                 self.config.get("world_update_threshold", 0.01),
+                                                 self.config.get("keyframe_interval", 20))
 
         self.players: Dict[int, connection.ServerConnection] = {}
         self.entities: Dict[int, types.Entity] = {}
@@ -63,12 +95,20 @@ class ServerProtocol(base.BaseProtocol):
         self.init_hooks()
         self.mode.start()
         self.scripts.load_scripts()
+        self.map_cache.refresh()
+        self.preload_next_map()
+        if self.map_saver is not None:
+            self.loop.create_task(self.map_saver.run())
         await super().run()
 
     def stop(self):
         self.scripts.unload_scripts()
         print("Unloaded scripts")
         super().stop()
+        if self.map_saver is not None:
+            self.map_saver.save()
+            print("Saved map")
+        self.executor.shutdown(wait=False)
 
     def update(self, dt):
         super().update(dt)
@@ -79,15 +119,112 @@ class ServerProtocol(base.BaseProtocol):
         for obj in self.objects:
             obj.update(dt)
         self.mode.update(dt)
+        self.update_collapses()
+        self.send_block_changes()
+
+    def send_updates(self):
         self.world_update()
 
+    def create_map_cache(self) -> 'transfer.MapCache':
+        # parsed maps and their compressed downloads are saved in "map_snapshots", so restarts can skip both. None
+        # to disable
+        return transfer.MapCache(self, journal=self.config.get("map_journal", False),
+                                 snapshots=self.config.get("map_snapshots"))
+
+    def preload_next_map(self):
+        """Start loading the next map of the rotation, so it's ready by the time the round ends."""
+        if len(self.map_rotation) == 1 and self.map_index == 0:
+            return
+        path = self.map_rotation[(self.map_index + 1) % len(self.map_rotation)]
+        self.next_map = self.loop.create_task(self._preload_map(path))
+
+    async def _preload_map(self, path: str) -> 'transfer.MapCache':
+        map_cache = self.create_map_cache()
+        await map_cache.open_async(path)
+        await map_cache.get()
+        return map_cache
+
+    async def rotate_map(self) -> bool:
+        """
+        Switch to the next map of the rotation, waiting for it to finish loading if it hasn't yet.
+        Returns whether the map was switched.
+        """
+        if self.next_map is None:
+            return False
+        task, self.next_map = self.next_map, None
+        self.map_index = (self.map_index + 1) % len(self.map_rotation)
+        try:
+            map_cache = await task
+            switched = True
+        except (OSError, ValueError) as e:
+            print(f"Could not load map {self.map_rotation[self.map_index]}: {e}")
+            switched = False
+        if switched:
+            self.set_map(map_cache)
+        self.preload_next_map()
+        return switched
+
+    def set_map(self, map_cache: 'transfer.MapCache'):
+        """
+        Switch to the map `map_cache` serves. Everything in the world is moved over to it as is, and every player
+        downloads it again and respawns once they have it.
+        """
+        self.map_cache = map_cache
+        self.map = map_cache.current
+        if self.map_saver is not None:
+            # the last edits to the old map are still saved
+            self.map_saver.checkpoint()
+            self.map_saver.set_map(self.map)
+        # these were made to the old map
+        self.block_changes.clear()
+
+        for conn in self.connections.values():
+            if conn.wo is not None:
+                conn.wo.set_map(self.map)
+        for obj in self.objects:
+            if isinstance(obj, types.Explosive):
+                obj.wo.set_map(self.map)
+        # including clients that have the old map but haven't joined a team yet
+        for conn in self.connections.values():
+            conn.reload_map()
+
+    def update_collapses(self):
+        if not self.map.pending_collapses:
+            return
+        # clients run the same check as soon as they see the block destroyed, so this only catches the server up
+        collapsed = self.map.step_collapses(self.collapse_budget)
+        if collapsed:
+            self.loop.create_task(connection.ServerConnection.on_blocks_collapse(None, collapsed))
+
+    def queue_block_changes(self, points: Iterable[Tuple[int, int, int]], color: tuple=None):
+        """
+        Queue blocks built with `color` (or destroyed, if it's None) to be sent at the end of the tick. Blocks built
+        and destroyed again within the same tick are never sent at all.
+        """
+        changes = self.block_changes
+        for point in points:
+            change = changes.get(point)
+            if change is None:
+                # blocks are only ever built where there weren't any (see VXLMap.build_point)
+                changes[point] = [color is None, color]
+            elif color is None and not change[0]:
+                del changes[point]
+            else:
+                change[1] = color
+
+    def send_block_changes(self):
+        if not self.block_changes:
+            return
+        changes = list(self.block_changes.items())
+        self.block_changes.clear()
+        for start in range(0, len(changes), SERVER_BLOCK_ITEMS):
+            server_block_action.reset()
+            for (x, y, z), (_, color) in changes[start:start + SERVER_BLOCK_ITEMS]:
+                server_block_action.add_block(x, y, z, packets.Color(*color) if color is not None else None)
+            self.broadcast_loader(server_block_action)
+
     def world_update(self):
-        world_update.clear()
-        for conn in self.players.values():
-            if not conn.name or conn.dead:
-                continue
-            world_update[conn.id] = (conn.position.xyz, conn.orientation)
-        self.broadcast_loader(world_update, flags=enet.PACKET_FLAG_UNSEQUENCED)
+        self.interest.send_world_update()
 
     def _broadcast_loader(self, writer: ByteWriter, flags=enet.PACKET_FLAG_RELIABLE, predicate=None, connections=None):
         packet: enet.Packet = enet.Packet(bytes(writer), flags)
@@ -240,13 +377,16 @@ class ServerProtocol(base.BaseProtocol):
             x, y, z = hook
 
         if self.map.build_point(x, y, z, color):
-            set_color.player_id = 32
-            set_color.color.rgb = color
-            self.broadcast_loader(set_color)
-            block_action.player_id = 32
-            block_action.xyz = (x, y, z)
-            block_action.value = ACTION.BUILD
-            self.broadcast_loader(block_action)
+            if self.batch_block_changes:
+                self.queue_block_changes(((x, y, z),), color)
+            else:
+                set_color.player_id = 32
+                set_color.color.rgb = color
+                self.broadcast_loader(set_color)
+                block_action.player_id = 32
+                block_action.xyz = (x, y, z)
+                block_action.value = ACTION.BUILD
+                self.broadcast_loader(block_action)
             self.loop.create_task(connection.ServerConnection.on_build_block(None, x, y, z))
             return True
         return False
@@ -267,13 +407,18 @@ class ServerProtocol(base.BaseProtocol):
                     for az in range(z - 1, z + 2):
                         to_destroy.append((ax, ay, az))
 
-        for ax, ay, az in to_destroy:
-            self.map.destroy_point(ax, ay, az)
-        block_action.player_id = 32
-        block_action.xyz = (x, y, z)
-        block_action.value = destroy_type
-        self.broadcast_loader(block_action)
+        destroyed = []
+        collapsed = self.map.destroy_points(to_destroy, self.collapse_budget, destroyed)
+        if self.batch_block_changes:
+            self.queue_block_changes(destroyed)
+        else:
+            block_action.player_id = 32
+            block_action.xyz = (x, y, z)
+            block_action.value = destroy_type
+            self.broadcast_loader(block_action)
         self.loop.create_task(connection.ServerConnection.on_destroy_block(None, x, y, z, destroy_type))
+        if collapsed:
+            self.loop.create_task(connection.ServerConnection.on_blocks_collapse(None, collapsed))
         return True
 
     def intercept(self, address: enet.Address, data: bytes):
@@ -0,0 +1,532 @@
+import asyncio
+import contextlib
+import hashlib
+import mmap
+import os
+import re
+import struct
+import zlib
+from collections import OrderedDict, deque
+from typing import *
+
+import enet
+
+from acelib import packets, vxl
+from acelib.constants import ACTION, SERVER_BLOCK_ITEMS, UPDATE_FREQUENCY
+from aceserver import protocol, connection, autosave
+from aceserver.loaders import map_chunk, set_color, block_action, server_block_action
+
+__all__ = ["MapCache", "Pack", "TransferScheduler", "Transfer", "JoinQueue"]
+
+MAP_CHUNK_SIZE = 16 * 1024
+# map chunks (of vxl.VXL_CHUNK_COLUMNS columns each) deflated together as one independently compressed segment
+SEGMENT_CHUNKS = 16
+# past this many dirty chunks, a rebuild serializes a snapshot of the whole map in a worker instead
+SNAPSHOT_CHUNKS = 256
+# player id used for blocks placed by the server itself
+SERVER_PLAYER_ID = 32
+
+DEFAULT_TRANSFER_RATE = 2 * 1024 * 1024
+# bounds on how much unacknowledged data a single transfer may have queued
+MIN_WINDOW = 16 * 1024
+MAX_WINDOW = 512 * 1024
+MIN_CHUNK_SIZE = 1024
+MAX_CHUNK_SIZE = 16 * 1024
+# acks are handled as soon as they arrive (see BaseProtocol.net_readable), except on event loops without add_reader,
+# where they wait for the next tick. so allow for one tick of delay (at the default tick rate)
+ACK_DELAY = UPDATE_FREQUENCY
+
+SNAPSHOT_MAGIC = b"ACESNAP1"
+# magic, sha1 of the vxl file, compression level of the download, whether the download is the whole file compressed
+# at once (journal mode) or deflate segments, size of the map snapshot, number of download parts. followed by the map
+# snapshot, the size of each part, then the parts
+SNAPSHOT_HEADER = struct.Struct("<8s20sBBQI")
+
+
+class MapCache:
+    """
+    Compressed copy of a map, split into ready-to-send MapChunk packets.
+
+    Every connecting client shares the same chunk list; it's only rebuilt once the map is swapped out or edited
+    since the last build. Downloads that are already running keep the list they started with. The protocol keeps one
+    for the map being played, and another for the next map of its rotation while that one is loaded ahead of time.
+
+    The zlib stream is made of raw deflate segments that each start with an empty history and end on a byte
+    boundary, so an edit only costs re-serializing the dirty map chunks and recompressing the segments they're in.
+
+    In journal mode the map is instead sent exactly as it was read from disk (compressed once, in `load`), followed
+    by the map's journal of edits made since then, replayed as block actions (or server block actions, if the protocol
+batches block changes).
+
+    Serialization and compression run on the protocol's executor, so builds never stall the event loop.
+
+    With a snapshot directory, maps opened with `open` are saved there once parsed and compressed, keyed by the hash
+    of the vxl file. Opening the same file again loads the map from its snapshot and reuses the compressed download.
+    """
+    def __init__(self, protocol: 'protocol.ServerProtocol', level: int=9, journal: bool=False, snapshots: str=None):
+        self.protocol = protocol
+        self.level = level
+        self.journal = journal
+        self.snapshots = snapshots
+
+        # the map being served, and the one the chunks were built from
+        self.current: vxl.VXLMap = None
+        self.map: vxl.VXLMap = None
+        self.revision: int = None
+        self.size: int = 0
+        self.chunks: List[bytes] = []
+
+        self._raw: List[bytes] = []
+        self._segments: List[bytes] = []
+
+        self._journal_revision: int = None
+        self._journal_packets: List[bytes] = []
+
+        # snapshot to save once the download is built: path, vxl hash, map snapshot, the map and its revision
+        self._snapshot: tuple = None
+
+        self._task: asyncio.Task = None
+
+    @property
+    def stale(self) -> bool:
+        map = self.current
+        if map is not self.map:
+            return True
+        return not self.journal and map.revision != self.revision
+
+    def open(self, path: str) -> vxl.VXLMap:
+        """Read the map at `path`, from its snapshot if one was saved for this exact file, and serve it."""
+        return self._use(*self.read(path))
+
+    async def open_async(self, path: str) -> vxl.VXLMap:
+        """Like `open`, but reads and parses the map on the protocol's executor."""
+        loaded = await self.protocol.loop.run_in_executor(self.protocol.executor, self.read, path)
+        return self._use(*loaded)
+
+    def read(self, path: str) -> Tuple[vxl.VXLMap, bytes, Optional[List[bytes]], Optional[tuple]]:
+        """
+        The map at `path`, the file data, its saved download if there is one, and otherwise the snapshot to save once
+        it's built. Doesn't touch the cache, so it's safe to call from a worker thread.
+        """
+        data = autosave.read_map(path)
+        map_info = {"name": os.path.splitext(path)[0]}
+        if self.snapshots is None:
+            return vxl.VXLMap(data, map_info), data, None, None
+
+        digest = hashlib.sha1(data).digest()
+        snapshot_path = os.path.join(self.snapshots, f"{os.path.basename(map_info['name'])}-{digest.hex()[:16]}.snap")
+        map, parts = None, None
+        if os.path.exists(snapshot_path):
+            try:
+                map, parts = self.read_snapshot(snapshot_path, digest, map_info)
+            except (OSError, ValueError, struct.error) as e:
+                print(f"Ignoring map snapshot {snapshot_path}: {e}")
+        if map is None:
+            map = vxl.VXLMap(data, map_info)
+        if parts is not None:
+            return map, data, parts, None
+        return map, data, None, (snapshot_path, digest, map.get_snapshot(), map, map.revision)
+
+    def _use(self, map: vxl.VXLMap, data: bytes, parts: Optional[List[bytes]], snapshot: Optional[tuple]) -> vxl.VXLMap:
+        self.current = map
+        self._snapshot = snapshot
+        if parts is None:
+            self.load(map, data)
+        elif self.journal:
+            map.set_journaling(True)
+            self._set_data(map, None, parts[0])
+        else:
+            self._task = self.protocol.loop.create_task(self._unpack(map.copy(), map, map.revision, parts))
+        return map
+
+    def load(self, map: vxl.VXLMap, data: bytes):
+        """Called with the file data `map` was just read from."""
+        if not self.journal:
+            return
+        map.set_journaling(True)
+        self._task = self.protocol.loop.create_task(self._load(map, data))
+
+    async def _load(self, map: vxl.VXLMap, data: bytes):
+        loop = self.protocol.loop
+        data = await loop.run_in_executor(self.protocol.executor, zlib.compress, data, self.level)
+        self._set_data(map, None, data)
+        await self._save_snapshot(map, None, [data])
+
+    async def _unpack(self, snapshot: vxl.VXLMap, map: vxl.VXLMap, revision: int, segments: List[bytes]):
+        # the segments were compressed from the same map, only the uncompressed chunks are needed again (for the
+        # checksum, and for recompressing segments once it's edited)
+        loop, executor = self.protocol.loop, self.protocol.executor
+        raw = await loop.run_in_executor(executor, snapshot.get_chunks)
+        data = await loop.run_in_executor(executor, self.assemble, raw, segments)
+        self._raw = raw
+        self._segments = segments
+        self._set_data(map, revision, data)
+
+    def read_snapshot(self, path: str, digest: bytes, map_info: dict) -> Tuple[Optional[vxl.VXLMap], Optional[List[bytes]]]:
+        """The map saved at `path`, and its download if it was compressed the way this cache would."""
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, file_digest, level, whole, map_size, part_count = SNAPSHOT_HEADER.unpack_from(data)
+            if magic != SNAPSHOT_MAGIC or file_digest != digest:
+                return None, None
+            offset = SNAPSHOT_HEADER.size
+            with memoryview(data)[offset:offset + map_size] as view:
+                map = vxl.VXLMap.from_snapshot(view, map_info)
+            offset += map_size
+            sizes = struct.unpack_from(f"<{part_count}Q", data, offset)
+            offset += 8 * part_count
+            parts = []
+            for size in sizes:
+                parts.append(data[offset:offset + size])
+                offset += size
+        if level != self.level or bool(whole) != self.journal:
+            return map, None
+        return map, parts
+
+    @staticmethod
+    def write_snapshot(path: str, digest: bytes, map_snapshot: bytes, whole: bool, level: int, parts: List[bytes]):
+        directory, name = os.path.split(path)
+        os.makedirs(directory, exist_ok=True)
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, digest, level, whole, len(map_snapshot), len(parts))
+        with open(path + ".tmp", "wb") as f:
+            f.write(header)
+            f.write(map_snapshot)
+            f.write(struct.pack(f"<{len(parts)}Q", *(len(part) for part in parts)))
+            for part in parts:
+                f.write(part)
+        os.replace(path + ".tmp", path)
+
+        # snapshots of older versions of the same map won't be needed again
+        pattern = re.compile(re.escape(name[:name.rindex("-")]) + r"-[0-9a-f]{16}\.snap")
+        for other in os.listdir(directory):
+            if other != name and pattern.fullmatch(other):
+                os.remove(os.path.join(directory, other))
+
+    async def _save_snapshot(self, map: vxl.VXLMap, revision: Optional[int], parts: List[bytes]):
+        if self._snapshot is None:
+            return
+        path, digest, map_snapshot, snapshot_map, snapshot_revision = self._snapshot
+        # only a download of the map exactly as it was parsed can go with it
+        if map is not snapshot_map or (revision is not None and revision != snapshot_revision):
+            return
+        self._snapshot = None
+        try:
+            await self.protocol.loop.run_in_executor(self.protocol.executor, self.write_snapshot, path, digest,
+                                                     map_snapshot, self.journal, self.level, parts)
+        except OSError as e:
+            print(f"Could not save map snapshot {path}: {e}")
+
+    def refresh(self) -> Optional[asyncio.Task]:
+        """Start rebuilding in the background if the map changed. Returns the build in progress, if there is one."""
+        if self._task is None or self._task.done():
+            if not self.stale:
+                return None
+            self._task = self.protocol.loop.create_task(self.build())
+        return self._task
+
+    async def get(self) -> Tuple[int, List[bytes]]:
+        task = self._task
+        if task is not None and not task.done():
+            await asyncio.shield(task)
+        task = self.refresh()
+        if task is not None:
+            await asyncio.shield(task)
+        return self.size, self.chunks
+
+    async def build(self):
+        loop, executor = self.protocol.loop, self.protocol.executor
+        map = self.current
+        revision = map.revision
+
+        dirty = map.get_dirty_chunks(self.revision) if map is self.map and self.revision is not None else None
+        if dirty is None or len(dirty) > SNAPSHOT_CHUNKS:
+            # the map keeps changing while the worker reads it, so serialize a copy
+            snapshot = map.copy()
+            raw = await loop.run_in_executor(executor, snapshot.get_chunks)
+            dirty = range(len(raw))
+        else:
+            raw = list(self._raw)
+            for index in dirty:
+                raw[index] = map.get_chunk(index)
+
+        segment_count = (len(raw) + SEGMENT_CHUNKS - 1) // SEGMENT_CHUNKS
+        segments = list(self._segments) if len(self._segments) == segment_count else [b''] * segment_count
+        dirty_segments = sorted({index // SEGMENT_CHUNKS for index in dirty})
+        compressed = await asyncio.gather(*(
+            loop.run_in_executor(executor, self.compress_segment, raw[segment * SEGMENT_CHUNKS:(segment + 1) * SEGMENT_CHUNKS])
+            for segment in dirty_segments
+        ))
+        for segment, data in zip(dirty_segments, compressed):
+            segments[segment] = data
+
+        data = await loop.run_in_executor(executor, self.assemble, raw, segments)
+        self._raw = raw
+        self._segments = segments
+        self._set_data(map, revision, data)
+        await self._save_snapshot(map, revision, segments)
+
+    def _set_data(self, map: vxl.VXLMap, revision: Optional[int], data: bytes):
+        chunks = []
+        for start in range(0, len(data), MAP_CHUNK_SIZE):
+            map_chunk.data = data[start:start + MAP_CHUNK_SIZE]
+            chunks.append(bytes(map_chunk.generate()))
+
+        self.map = map
+        self.revision = revision
+        self.size = len(data)
+        self.chunks = chunks
+        map.estimated_size = self.size
+
+    def compress_segment(self, chunks: List[bytes]) -> bytes:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = compressor.compress(b''.join(chunks))
+        return data + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    @staticmethod
+    def assemble(raw: List[bytes], segments: List[bytes]) -> bytes:
+        checksum = 1
+        for chunk in raw:
+            checksum = zlib.adler32(chunk, checksum)
+        # zlib header, the segments, an empty final block, then the adler32 of the whole map
+        return b''.join((b'\x78\xda', *segments, b'\x03\x00', struct.pack(">I", checksum)))
+
+    def get_journal(self) -> List[bytes]:
+        """Packets that bring a client that just downloaded the map from `get` up to date."""
+        map = self.current
+        if not self.journal or map is not self.map:
+            return []
+        if map.revision == self._journal_revision:
+            return self._journal_packets
+
+        journal_packets = []
+        journal = map.get_journal()
+        if self.protocol.batch_block_changes:
+            for start in range(0, len(journal), SERVER_BLOCK_ITEMS):
+                server_block_action.reset()
+                for x, y, z, color in journal[start:start + SERVER_BLOCK_ITEMS]:
+                    if color is not None:
+                        color = packets.Color((color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF)
+                    server_block_action.add_block(x, y, z, color)
+                journal_packets.append(bytes(server_block_action.generate()))
+        else:
+            color = None
+            block_action.player_id = set_color.player_id = SERVER_PLAYER_ID
+            for x, y, z, block_color in journal:
+                if block_color is None:
+                    block_action.value = ACTION.DESTROY
+                else:
+                    block_action.value = ACTION.BUILD
+                    if block_color & 0xFFFFFF != color:
+                        color = block_color & 0xFFFFFF
+                        set_color.color.rgb = (color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF
+                        journal_packets.append(bytes(set_color.generate()))
+                block_action.xyz = x, y, z
+                journal_packets.append(bytes(block_action.generate()))
+
+        self._journal_revision = map.revision
+        self._journal_packets = journal_packets
+        return journal_packets
+
+
+class Pack:
+    """
+    A pack file, memory-mapped so every download slices the same pages instead of holding its own copy.
+    """
+    CHUNK_HEADER = bytes((packets.PackChunk.id,))
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # can't map an empty file
+                self._mmap = b''
+        self.data = memoryview(self._mmap)
+        self.size = len(self.data)
+        self.checksum: int = None
+
+    def compute_checksum(self) -> int:
+        self.checksum = zlib.crc32(self.data)
+        return self.checksum
+
+    def chunk(self, offset: int, size: int) -> bytes:
+        """PackChunk packet for `size` bytes at `offset`."""
+        return self.CHUNK_HEADER + self.data[offset:offset + size]
+
+
+class TransferScheduler:
+    """
+    Paces bulk downloads (maps, packs) by how fast each peer is actually acknowledging them, within a server-wide
+    upload budget of `rate` bytes per second (0 for no limit) shared by every transfer in progress.
+    """
+    def __init__(self, protocol: 'protocol.ServerProtocol', rate: int=DEFAULT_TRANSFER_RATE):
+        self.protocol = protocol
+        self.rate = rate
+        self.transfers: Set['Transfer'] = set()
+
+        self._tokens = 0.0
+        self._updated = protocol.loop.time()
+
+    def open(self, conn: 'connection.ServerConnection') -> 'Transfer':
+        return Transfer(self, conn)
+
+    @property
+    def share(self) -> Optional[float]:
+        if not self.rate:
+            return None
+        return self.rate / max(1, len(self.transfers))
+
+    async def take(self, size: int):
+        if not self.rate:
+            return
+        loop = self.protocol.loop
+        burst = self.rate * ACK_DELAY * 2
+        while True:
+            now = loop.time()
+            self._tokens = min(burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens > 0:
+                self._tokens -= size
+                return
+            await asyncio.sleep(-self._tokens / self.rate)
+
+
+class Transfer:
+    """
+    A single download to one connection. Keeps about a bandwidth-delay product of unacknowledged data queued, so
+    a client on a fast link isn't held back by fixed sleeps and a slow one isn't buried under a backlog.
+    """
+    def __init__(self, scheduler: TransferScheduler, conn: 'connection.ServerConnection'):
+        self.scheduler = scheduler
+        self.conn = conn
+        self.outstanding = 0
+        self.sent = 0
+        self._acked = asyncio.Event()
+        # enet reuses peer slots, so this tells the peer we started sending to apart from whoever has its slot now
+        self._connect_id = conn.peer.connectID
+
+    async def __aenter__(self) -> 'Transfer':
+        self.scheduler.transfers.add(self)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.scheduler.transfers.discard(self)
+
+    @property
+    def connected(self) -> bool:
+        peer = self.conn.peer
+        return peer.state == enet.PEER_STATE_CONNECTED and peer.connectID == self._connect_id
+
+    @property
+    def window(self) -> int:
+        share = self.scheduler.share
+        if share is None:
+            return MAX_WINDOW
+        delay = self.conn.peer.roundTripTime / 1000 + ACK_DELAY
+        return int(max(MIN_WINDOW, min(share * delay * 2, MAX_WINDOW)))
+
+    @property
+    def chunk_size(self) -> int:
+        return max(MIN_CHUNK_SIZE, min(self.window // 4, MAX_CHUNK_SIZE))
+
+    async def send(self, data: bytes):
+        size = len(data)
+        while self.outstanding and self.outstanding + size > self.window:
+            self._acked.clear()
+            try:
+                await asyncio.wait_for(self._acked.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+            if not self.connected:
+                raise ConnectionError("peer disconnected during transfer")
+        await self.scheduler.take(size)
+        # disconnecting frees the queued packets, which looks just like them being acknowledged
+        if not self.connected:
+            raise ConnectionError("peer disconnected during transfer")
+
+        packet = enet.Packet(data, enet.PACKET_FLAG_RELIABLE)
+        packet.set_free_callback(lambda: self._on_ack(size))
+        self.outstanding += size
+        self.sent += size
+        self.conn.peer.send(0, packet)
+
+    def _on_ack(self, size: int):
+        self.outstanding -= size
+        self._acked.set()
+
+
+class JoinQueue:
+    """
+    Caps how many connections download packs and the map at once (0 for no limit). Everyone else waits in join
+    order, so a wave of joins doesn't starve live players' traffic and each admitted download runs at full speed.
+    """
+    def __init__(self, protocol: 'protocol.ServerProtocol', slots: int=4):
+        self.protocol = protocol
+        self.slots = slots
+        self.active: Set['connection.ServerConnection'] = set()
+        self.waiting: Dict['connection.ServerConnection', Tuple[asyncio.Future, float]] = OrderedDict()
+        # seconds spent queued by the most recently admitted connections
+        self.wait_times: Deque[float] = deque(maxlen=100)
+
+    @property
+    def depth(self) -> int:
+        return len(self.waiting)
+
+    @property
+    def average_wait(self) -> float:
+        return sum(self.wait_times) / len(self.wait_times) if self.wait_times else 0.0
+
+    def position(self, conn: 'connection.ServerConnection') -> Optional[int]:
+        for position, other in enumerate(self.waiting, 1):
+            if other is conn:
+                return position
+        return None
+
+    @contextlib.asynccontextmanager
+    async def admit(self, conn: 'connection.ServerConnection'):
+        await self._acquire(conn)
+        try:
+            yield
+        finally:
+            self._release(conn)
+
+    async def _acquire(self, conn: 'connection.ServerConnection'):
+        if not self.waiting and (not self.slots or len(self.active) < self.slots):
+            self.active.add(conn)
+            self.wait_times.append(0.0)
+            return
+
+        fut = self.protocol.loop.create_future()
+        self.waiting[conn] = (fut, self.protocol.loop.time())
+        self._notify(conn, len(self.waiting))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            self.cancel(conn)
+            raise
+
+    def _release(self, conn: 'connection.ServerConnection'):
+        self.active.discard(conn)
+        admitted = False
+        while self.waiting and (not self.slots or len(self.active) < self.slots):
+            conn, (fut, queued) = self.waiting.popitem(last=False)
+            self.active.add(conn)
+            self.wait_times.append(self.protocol.loop.time() - queued)
+            fut.set_result(None)
+            admitted = True
+        if admitted:
+            for position, conn in enumerate(self.waiting, 1):
+                self._notify(conn, position)
+
+    def cancel(self, conn: 'connection.ServerConnection'):
+        """Drop `conn` from the queue, e.g. because it disconnected while waiting."""
+        item = self.waiting.pop(conn, None)
+        if item is None:
+            return
+        fut, _ = item
+        if not fut.done():
+            fut.set_exception(ConnectionError("left the join queue"))
+        for position, conn in enumerate(self.waiting, 1):
+            self._notify(conn, position)
+
+    def _notify(self, conn: 'connection.ServerConnection', position: int):
+        conn.send_server_message(f"Server is busy, you are #{position} in the join queue")